@@ -0,0 +1,61 @@
+#!/usr/bin/python
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Copyright (C) 2014
+#    Richard Hughes <richard@hughsie.com>
+
+""" A dictionary that is saved to disk between runs """
+
+import os
+import json
+
+# internal
+from log import print_fail
+
+class JsonCache(object):
+    """ A dictionary that is saved to disk between runs """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = {}
+        self.changed = False
+        if not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, 'r') as f:
+                self.data = json.loads(f.read())
+        except (IOError, ValueError) as e:
+            print_fail("Failed to load %s: %s" % (self.filename, str(e)))
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        if self.data.get(key) == value:
+            return
+        self.data[key] = value
+        self.changed = True
+
+    def save(self):
+        """ Writes the file atomically, if anything has changed """
+        if not self.changed:
+            return
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(self.data))
+        os.rename(tmp, self.filename)
+        self.changed = False
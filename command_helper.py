@@ -0,0 +1,182 @@
+#!/usr/bin/python
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Copyright (C) 2014
+#    Richard Hughes <richard@hughsie.com>
+
+""" Runs commands, saving the output to log files """
+
+import collections
+import os
+import signal
+import subprocess
+import threading
+import time
+
+# internal
+from log import print_debug, print_fail
+
+_log_dir = None
+_timeout = None
+
+def setup_commands(log_dir=None, timeout=None):
+    """ Sets where the logs go and the default timeout in seconds """
+    global _log_dir, _timeout
+    if log_dir and not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    _log_dir = log_dir
+    _timeout = timeout
+
+def get_log_path(name):
+    """ Returns the log file for a package, or None if logs are not kept """
+    if not _log_dir:
+        return None
+    return os.path.join(_log_dir, name + '.log')
+
+class CommandResult(object):
+    """ The result of running a command, which is true for success """
+
+    def __init__(self, argv):
+        self.argv = argv
+        self.returncode = None
+        self.duration = 0
+        self.log_path = None
+        self.tail = []
+        self.timed_out = False
+        self.output = None
+
+    def get_tail(self):
+        """ Returns the last few lines of output """
+        return ''.join(self.tail)
+
+    def __nonzero__(self):
+        return self.returncode == 0
+
+    __bool__ = __nonzero__
+
+def _kill(p, finished, result, grace=10):
+    """ Kills the process group, giving it some time to exit cleanly """
+    result.timed_out = True
+    try:
+        os.killpg(p.pid, signal.SIGTERM)
+        if not finished.wait(grace):
+            os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+def _read_all(stream, result, log, lock):
+    """ Keeps all of the output, also writing it to the log """
+    lines = []
+    for line in iter(stream.readline, ''):
+        lines.append(line)
+        if log:
+            with lock:
+                log.write(line)
+    result.output = ''.join(lines)
+
+def _run(cwd, argv, log_path, timeout, tail_size, capture):
+    if timeout is None:
+        timeout = _timeout
+    result = CommandResult(argv)
+    result.log_path = log_path
+    tail = collections.deque(maxlen=tail_size)
+    log = None
+    if log_path:
+        log = open(log_path, 'a')
+        log.write("%s $ %s\n" % (time.strftime('%Y-%m-%d %H:%M:%S'), ' '.join(argv)))
+        log.flush()
+
+    # the command gets a process group of its own so all of it can be killed
+    print_debug("Running %s" % " ".join(argv))
+    start = time.time()
+    if capture:
+        stderr = subprocess.PIPE
+    else:
+        stderr = subprocess.STDOUT
+    p = subprocess.Popen(argv, cwd=cwd, stdout=subprocess.PIPE, stderr=stderr,
+                         preexec_fn=os.setsid, close_fds=True)
+    finished = threading.Event()
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, _kill, [p, finished, result])
+        timer.daemon = True
+        timer.start()
+    reader = None
+    lock = threading.Lock()
+    if capture:
+        reader = threading.Thread(target=_read_all, args=(p.stdout, result, log, lock))
+        reader.daemon = True
+        reader.start()
+        stream = p.stderr
+    else:
+        stream = p.stdout
+    try:
+        for line in iter(stream.readline, ''):
+            tail.append(line)
+            if log:
+                with lock:
+                    log.write(line)
+        if reader:
+            reader.join()
+        p.wait()
+    finally:
+        # the command is not in our session, so it will not get our Ctrl-C
+        if p.returncode is None:
+            try:
+                os.killpg(p.pid, signal.SIGTERM)
+            except OSError:
+                pass
+        finished.set()
+        if timer:
+            timer.cancel()
+        if log:
+            log.close()
+    result.returncode = p.returncode
+    result.duration = time.time() - start
+    result.tail = list(tail)
+    return result
+
+def _print_failure(result):
+    if result.timed_out:
+        print_fail("%s timed out after %is" % (' '.join(result.argv), result.duration))
+    else:
+        print_fail("%s failed with %i after %is" % (' '.join(result.argv),
+                                                    result.returncode,
+                                                    result.duration))
+    print(result.get_tail().rstrip())
+    if result.log_path:
+        print_fail("See %s for the full output" % result.log_path)
+
+def run_command(cwd, argv, print_failures=True, log_path=None, timeout=None, tail_size=50):
+    """ Runs a command, returning a CommandResult which is false for failure
+
+    The output is written to log_path as it arrives and only the last
+    tail_size lines are kept in memory. If the command runs for longer than
+    timeout seconds then it is killed along with everything it started.
+    """
+    result = _run(cwd, argv, log_path, timeout, tail_size, False)
+    if not result and print_failures:
+        _print_failure(result)
+    return result
+
+def run_command_output(cwd, argv, log_path=None, timeout=None, tail_size=50):
+    """ Runs a command, returning the output or None for failure """
+    result = _run(cwd, argv, log_path, timeout, tail_size, True)
+    if not result:
+        _print_failure(result)
+        return None
+    return result.output
@@ -20,14 +20,18 @@
 
 """ Helper object for COPRs """
 
+import re
 import requests
-import urllib2
 import time
+import urllib
+
+from multiprocessing.pool import ThreadPool
 
 import copr_cli.subcommands
 
 # internal
 from log import print_info, print_fail, print_debug
+from http_helper import get_http_helper, HttpException
 
 class CoprBuildStatus:
     ALREADY_BUILT = 1
@@ -38,19 +42,208 @@ class CoprBuildStatus:
 class CoprException(Exception):
     pass
 
+class CoprPolledBuild(object):
+    """ A build being watched by CoprBuildPoller """
+
+    def __init__(self, pkg, interval):
+        self.pkg = pkg
+        self.status = None
+        self.interval = interval
+        self.next_poll = time.time() + interval
+        self.started = time.time()
+
+class CoprBuildPoller(object):
+    """ Polls the status of lots of COPR builds at the same time
+
+    Each build is polled less often while its status stays the same, and
+    more often again when the status changes or when it has been running
+    about as long as the builds that have already finished. The callback
+    is called with (pkg, success) as soon as each build finishes.
+    """
+
+    def __init__(self, api_url, jobs=8, min_interval=5, max_interval=120, callback=None):
+        self.api_url = api_url
+        self.jobs = jobs
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.callback = callback
+        self.builds = {}
+        self.nvrs = set()
+        self.durations = []
+        self._pool = None
+
+    def add(self, pkg):
+        """ Starts watching a build """
+        self.builds[pkg.build_id] = CoprPolledBuild(pkg, self.min_interval)
+        self.nvrs.add(pkg.get_nvr())
+
+    def _fetch_status(self, build_id):
+        """ Returns the status of a build, or None for failure """
+        url = '{0}/coprs/build_status/{1}/'.format(self.api_url, build_id)
+        try:
+            response = get_http_helper().get(url)
+            output = response.json()
+        except (HttpException, ValueError) as e:
+            print_fail("Unable to get build status for %i: %s" % (build_id, str(e)))
+            return None
+        if output.get('output') != 'ok':
+            print_fail("Unable to get build status for %i: %s" % (build_id, output.get('error')))
+            return None
+        return output['status']
+
+    def _get_typical_duration(self):
+        if not self.durations:
+            return None
+        return sorted(self.durations)[len(self.durations) / 2]
+
+    def _reschedule(self, build, status):
+        now = time.time()
+        typical = self._get_typical_duration()
+        if status != build.status:
+            build.interval = self.min_interval
+        elif typical and status == 'running' and now - build.started > typical * 0.8:
+            build.interval = self.min_interval
+        else:
+            build.interval = min(build.interval * 2, self.max_interval)
+        build.status = status
+        build.next_poll = now + build.interval
+
+    def poll(self):
+        """ Polls the builds that are due, returning a list of (pkg, success)
+        for the ones that have finished """
+        now = time.time()
+        due = [build for build in self.builds.values() if build.next_poll <= now]
+        if not due:
+            return []
+
+        # the same threads are used for every poll so their HTTP sessions
+        # keep the connections to the API open
+        if not self._pool:
+            self._pool = ThreadPool(self.jobs)
+        statuses = self._pool.map(self._fetch_status, [build.pkg.build_id for build in due])
+        finished = []
+        for build, status in zip(due, statuses):
+            pkg = build.pkg
+            if status in ('succeeded', 'skipped'):
+                print_debug("Build %s [%i] succeeded" % (pkg.name, pkg.build_id))
+                self.durations.append(time.time() - build.started)
+                success = True
+            elif status in ('failed', 'canceled') or status is None:
+                print_fail("Build %s [%i] failed" % (pkg.name, pkg.build_id))
+                success = False
+            else:
+                self._reschedule(build, status)
+                continue
+            del self.builds[pkg.build_id]
+            self.nvrs.discard(pkg.get_nvr())
+            finished.append((pkg, success))
+            if self.callback:
+                self.callback(pkg, success)
+        return finished
+
+    def get_delay(self):
+        """ Returns how long to wait until the next build is due a poll """
+        if not self.builds:
+            return 0
+        next_poll = min([build.next_poll for build in self.builds.values()])
+        return max(next_poll - time.time(), 0)
+
+_listing_re = re.compile(r'<a href="([^"/?]+)/">')
+
+class CoprResultIndex(object):
+    """ Finds the status of builds in one COPR chroot
+
+    The results directory is listed once, and only the builds that have a
+    directory there are probed for the success, fail and build.log files,
+    using HEAD requests so nothing is downloaded. Answers are kept for the run.
+    """
+
+    def __init__(self, url, jobs=8):
+        self.url = url
+        self.jobs = jobs
+        self._dirs = None
+        self._status = {}
+
+    def _get_dirs(self):
+        """ Returns the set of build directories in the chroot """
+        if self._dirs is not None:
+            return self._dirs
+        try:
+            ret = get_http_helper().get(self.url, timeout=30)
+        except HttpException as e:
+            # cloud is down
+            raise CoprException(str(e))
+
+        # nothing has been built yet
+        if ret.status_code == 404:
+            self._dirs = set()
+        elif ret.status_code != 200:
+            raise CoprException("%s returned %i" % (self.url, ret.status_code))
+        else:
+            self._dirs = set([urllib.unquote(d) for d in _listing_re.findall(ret.text)])
+        return self._dirs
+
+    def _url_exists(self, url):
+        try:
+            ret = get_http_helper().head(url, timeout=5)
+        except HttpException as e:
+            raise CoprException(str(e))
+        if ret.status_code == 404:
+            return False
+        if ret.status_code != 200:
+            raise CoprException("%s returned %i" % (url, ret.status_code))
+        return True
+
+    def _probe(self, nvr):
+        if nvr not in self._get_dirs():
+            return CoprBuildStatus.NOT_FOUND
+        url = self.url + urllib.quote(nvr) + '/'
+        if self._url_exists(url + 'success'):
+            return CoprBuildStatus.ALREADY_BUILT
+        if self._url_exists(url + 'fail'):
+            return CoprBuildStatus.FAILED_TO_BUILD
+
+        # a canceled build leaves a directory with no log
+        if self._url_exists(url + 'build.log'):
+            return CoprBuildStatus.IN_PROGRESS
+        return CoprBuildStatus.NOT_FOUND
+
+    def prefetch(self, nvrs):
+        """ Probes lots of builds at the same time """
+        dirs = self._get_dirs()
+        todo = [nvr for nvr in set(nvrs) if nvr in dirs and nvr not in self._status]
+        if not todo:
+            return
+        pool = ThreadPool(min(self.jobs, len(todo)))
+        try:
+            statuses = pool.map(self._probe, todo)
+        finally:
+            pool.close()
+            pool.join()
+        self._status.update(zip(todo, statuses))
+
+    def get_status(self, nvr):
+        """ Returns the CoprBuildStatus for a build """
+        status = self._status.get(nvr)
+        if status is None:
+            status = self._probe(nvr)
+            self._status[nvr] = status
+        return status
+
 class CoprHelper(object):
     """ Helper object for COPRs """
 
     def __init__(self, copr_id):
         self.copr_id = copr_id
-        self.builds_in_progress = []
         self.release = copr_id.split('-')[0]
+        self.poller = CoprBuildPoller(copr_cli.subcommands.get_api_url())
+        self.results = None
 
     def build(self, pkg):
         """ Build a new package into a given COPR """
 
         # already in the queue
-        if pkg in self.builds_in_progress:
+        if pkg.get_nvr() in self.poller.nvrs:
             return True
 
         user = copr_cli.subcommands.get_user()
@@ -75,13 +268,14 @@ class CoprHelper(object):
             print_debug(output['message'])
         pkg.build_id = output['ids'][0]
         print_debug("Adding build " + str(pkg.build_id))
-        self.builds_in_progress.append(pkg)
+        self.poller.add(pkg)
         return True
 
-    def _url_exists(self, pkg, filename):
-        """ Checks to see if a package has already been built successfully """
-        baseurl = 'http://copr-be.cloud.fedoraproject.org/'
-        url = baseurl + 'results/rhughes/'
+    def _get_result_index(self):
+        """ Returns the result index for the chroot, or None if unknown """
+        if self.results:
+            return self.results
+        url = 'http://copr-be.cloud.fedoraproject.org/results/rhughes/'
         url += self.copr_id
         if self.release == 'f20':
             url += '/fedora-20-x86_64/'
@@ -90,71 +284,131 @@ class CoprHelper(object):
         elif self.release == 'el7':
             url += '/epel-7-x86_64/'
         else:
-            return True
-        url += pkg.get_nvr()
-        url += '/' + filename
-        try:
-            ret = urllib2.urlopen(url, None, 5)
-            return ret.code == 200
-        except urllib2.URLError, e:
-            # build does not exist, or did not succeed
-            if str(e).find('Not Found') > 0:
-                return False
+            return None
+        self.results = CoprResultIndex(url)
+        return self.results
 
-            # cloud is down
-            if str(e).find('No route to host') > 0:
-                raise CoprException("No route to host %s" % baseurl)
-            elif str(e).find('error timed out') > 0:
-                raise CoprException("Host %s timed out" % baseurl)
-            else:
-                raise CoprException(str(e))
-            return True
-        return False
+    def prefetch_pkg_status(self, pkgs):
+        """ Finds the status of lots of packages at the same time """
+        results = self._get_result_index()
+        if results:
+            results.prefetch([pkg.get_nvr() for pkg in pkgs])
 
     def get_pkg_status(self, pkg):
-        # check for success
-        if self._url_exists(pkg, 'success'):
+        results = self._get_result_index()
+        if not results:
             return CoprBuildStatus.ALREADY_BUILT
-        # check for failure
-        if self._url_exists(pkg, 'fail'):
-            return CoprBuildStatus.FAILED_TO_BUILD
-        # check for in progress
-        if self._url_exists(pkg, 'build.log'):
-            return CoprBuildStatus.IN_PROGRESS
-        return CoprBuildStatus.NOT_FOUND
+        return results.get_status(pkg.get_nvr())
+
+    def poll_builds(self):
+        """ Checks the builds that are due, returning a list of (pkg, success)
+        for the ones that have finished """
+        return self.poller.poll()
 
     def wait_for_builds(self):
         """ Waits for all submitted builds to finish """
 
         # nothing to do
-        if len(self.builds_in_progress) == 0:
+        if not self.poller.builds:
             return True
 
         success = True
-        for pkg in self.builds_in_progress:
-            print_info("Waiting for %s [%i]" % (pkg.get_nvr(), pkg.build_id))
+        for build in self.poller.builds.values():
+            print_info("Waiting for %s [%i]" % (build.pkg.get_nvr(), build.pkg.build_id))
         try:
-            while len(self.builds_in_progress) > 0:
-                for pkg in self.builds_in_progress:
-                    try:
-                        (ret, status) = copr_cli.subcommands._fetch_status(pkg.build_id)
-                    except requests.exceptions.ConnectionError, e:
-                        self.builds_in_progress.remove(pkg)
-                        print_fail("Lost connection for build %i" % pkg.build_id)
-                        success = False
+            while self.poller.builds:
+                time.sleep(self.poller.get_delay())
+                for pkg, ret in self.poller.poll():
                     if not ret:
-                        self.builds_in_progress.remove(pkg)
-                        print_fail("Unable to get build status for %i" % pkg.build_id)
-                        continue
-                    if status == 'succeeded':
-                        self.builds_in_progress.remove(pkg)
-                        print_debug("Build %s [%i] succeeded" % (pkg.name, pkg.build_id))
-                    elif status == 'failed':
-                        self.builds_in_progress.remove(pkg)
-                        print_fail("Build %s [%i] failed" % (pkg.name, pkg.build_id))
                         success = False
-                    time.sleep(1)
-                time.sleep(10)
         except KeyboardInterrupt:
             success = False
         return success
+
+class CoprScheduler(object):
+    """ Builds packages as soon as the packages they depend on are built
+
+    Dependencies on keys that were never added are looked through using
+    get_deps, so a package still waits for anything further down the
+    tree that is being built.
+    """
+
+    def __init__(self, copr, max_builds=10, get_deps=None):
+        self.copr = copr
+        self.max_builds = max_builds
+        self.get_deps = get_deps
+        self.keys = []
+        self.pkgs = {}
+        self.deps = {}
+        self.results = {}
+        self.building = {}
+
+    def add(self, key, pkg, deps):
+        """ Adds a package to build once all of deps have been built """
+        self.keys.append(key)
+        self.pkgs[key] = pkg
+        self.deps[key] = deps
+
+    def _build_finished(self, pkg, success):
+        key = self.building.pop(pkg.build_id, None)
+        if key:
+            self.results[key] = success
+
+    def _get_scheduled_deps(self, key):
+        """ Returns the added keys that key depends on """
+        found = set()
+        seen = set()
+        todo = list(self.deps[key])
+        while todo:
+            dep = todo.pop()
+            if dep in seen:
+                continue
+            seen.add(dep)
+            if dep in self.pkgs:
+                found.add(dep)
+            elif self.get_deps:
+                todo.extend(self.get_deps(dep))
+        return found
+
+    def run(self):
+        """ Builds everything, returning False if anything failed """
+        waiting = []
+        deps = {}
+        for key in self.keys:
+            waiting.append(key)
+            deps[key] = self._get_scheduled_deps(key)
+        self.building = {}
+        self.copr.poller.callback = self._build_finished
+        try:
+            while waiting or self.building:
+
+                # start anything that can be built now
+                for key in list(waiting):
+                    failed = [dep for dep in deps[key] if self.results.get(dep) is False]
+                    if failed:
+                        print_fail("Not building %s as %s failed" % (key, ', '.join(failed)))
+                        self.results[key] = False
+                        waiting.remove(key)
+                        continue
+                    if len(self.building) >= self.max_builds:
+                        continue
+                    if [dep for dep in deps[key] if not self.results.get(dep)]:
+                        continue
+                    waiting.remove(key)
+                    pkg = self.pkgs[key]
+                    if not self.copr.build(pkg):
+                        print_fail("Failed to submit build of %s" % key)
+                        self.results[key] = False
+                        continue
+                    print_info("Building %s [%i]" % (pkg.get_nvr(), pkg.build_id))
+                    self.building[pkg.build_id] = key
+
+                # wait for the next build to finish
+                if self.building:
+                    time.sleep(self.copr.poller.get_delay())
+                    self.copr.poller.poll()
+        except KeyboardInterrupt:
+            return False
+        finally:
+            self.copr.poller.callback = None
+        return not [key for key in self.keys if not self.results.get(key)]
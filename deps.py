@@ -61,10 +61,9 @@ def main():
                 # remove pkgconfig() wrapper
                 if section.startswith('pkgconfig('):
                     section = section[10:-1]
-                    for item2 in data.items:
-                        if section == item2.pkgconfig:
-                            found.append(item2.name)
-                            break
+                    item2 = data._get_item_by_pkgconfig(section)
+                    if item2:
+                        found.append(item2.name)
                 else:
                     section = section.replace('NetworkManager-glib', 'NetworkManager')
                     section = section.replace('ModemManager-glib', 'ModemManager')
@@ -76,10 +75,9 @@ def main():
                     section = section.replace('libchamplain-gtk', 'libchamplain')
                     section = section.replace('gnome-bluetooth-libs-devel', 'gnome-bluetooth')
                     section = section.replace('-devel', '')
-                    for item2 in data.items:
-                        if section == item2.pkgname:
-                            found.append(item2.name)
-                            break
+                    item2 = data._get_item_by_pkgname(section)
+                    if item2:
+                        found.append(item2.name)
 
         for key in sorted(list(set(found))):
             print "    <dep>%s</dep>" % key
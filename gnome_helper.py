@@ -0,0 +1,180 @@
+#!/usr/bin/python
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Copyright (C) 2014
+#    Richard Hughes <richard@hughsie.com>
+
+""" Helper object for the GNOME download server """
+
+import os
+import json
+
+from multiprocessing.pool import ThreadPool
+
+# internal
+from log import print_debug, print_fail
+from http_helper import get_http_helper, HttpException
+from cache_helper import JsonCache
+
+class GnomeProject(object):
+    """ The upstream releases of a project """
+
+    def __init__(self, name):
+        self.name = name
+        self.versions = []
+        self.files = {}
+
+    def get_tarball(self, version):
+        """ Returns the path of the tarball relative to the project """
+        return self.files[version]['tar.xz']
+
+    def get_checksums(self, version):
+        """ Returns the path of the sha256sum file relative to the project """
+        return self.files[version].get('sha256sum')
+
+class GnomeHelper(object):
+    """ Helper object for the GNOME download server """
+
+    def __init__(self, baseurl='https://download.gnome.org/sources', jobs=8, cachedir=None):
+        self.baseurl = baseurl
+        self.jobs = jobs
+        self.http = get_http_helper()
+        self.cache = None
+        if cachedir:
+            self.cache = JsonCache(os.path.join(cachedir, 'upstream.json'))
+
+    def get_project_url(self, name):
+        """ Returns the URL of the directory holding all the releases """
+        return "%s/%s" % (self.baseurl, name)
+
+    def _project_from_cache(self, entry, name):
+        project = GnomeProject(name)
+        project.versions = entry['versions']
+        for version in entry['tarballs']:
+            tarball, checksums = entry['tarballs'][version]
+            files = {'tar.xz': tarball}
+            if checksums:
+                files['sha256sum'] = checksums
+            project.files[version] = files
+        return project
+
+    def _project_to_cache(self, project, response):
+        """ Returns the entry to save, with only the files we ever use """
+        tarballs = {}
+        for version in project.files:
+            files = project.files[version]
+            if 'tar.xz' in files:
+                tarballs[version] = [files['tar.xz'], files.get('sha256sum')]
+        return {'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'versions': project.versions,
+                'tarballs': tarballs}
+
+    def _parse(self, name, data):
+
+        # the format of the json file is as follows:
+        # j[0] = some kind of version number?
+        # j[1] = the files keyed for each release, e.g.
+        #        { 'pkgname' : {'2.91.1' : {u'tar.gz': u'2.91/gpm-2.91.1.tar.gz'} } }
+        # j[2] = array of remote versions, e.g.
+        #        { 'pkgname' : {  '3.3.92', '3.4.0' }
+        # j[3] = the LATEST-IS files
+        j = json.loads(data)
+        project = GnomeProject(name)
+        project.versions = j[2][name]
+        project.files = j[1][name]
+        return project
+
+    def get_project(self, name):
+        """ Downloads and parses the cache.json file for a project """
+        url = "%s/cache.json" % self.get_project_url(name)
+
+        # only download the file if it has changed since last time
+        headers = {}
+        entry = None
+        if self.cache:
+            entry = self.cache.get(name)
+
+        # saved by an older version without the tarballs
+        if entry and 'tarballs' not in entry:
+            entry = None
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            response = self.http.get(url, headers=headers)
+        except HttpException as e:
+            print_fail("Failed to get JSON for %s: %s" % (name, str(e)))
+            return None
+        if response.status_code == 304 and entry:
+            return self._project_from_cache(entry, name)
+        if response.status_code != 200:
+            print_fail("Failed to get JSON for %s: %i" % (name, response.status_code))
+            return None
+        try:
+            project = self._parse(name, response.content)
+        except Exception as e:
+            print_fail("Failed to read JSON at %s: %s" % (url, str(e)))
+            return None
+
+        # save the validators for next time
+        if self.cache:
+            self.cache.set(name, self._project_to_cache(project, response))
+        return project
+
+    def get_tarball_checksum(self, project, version):
+        """ Returns the published sha256 of the tarball for a release """
+        checksums = project.get_checksums(version)
+        if not checksums:
+            return None
+        url = self.get_project_url(project.name) + '/' + checksums
+        try:
+            response = self.http.get(url)
+        except HttpException as e:
+            print_fail("Failed to get checksums for %s: %s" % (project.name, str(e)))
+            return None
+        if response.status_code != 200:
+            print_fail("Failed to get checksums for %s: %i" % (project.name, response.status_code))
+            return None
+
+        # each line is '<sha256>  <filename>'
+        tarball = os.path.basename(project.get_tarball(version))
+        for line in response.text.splitlines():
+            data = line.split()
+            if len(data) == 2 and data[1] == tarball:
+                return data[0]
+        return None
+
+    def get_projects(self, names):
+        """ Gets the upstream data for lots of projects at the same time """
+        print_debug("Fetching upstream data for %i projects" % len(names))
+        pool = ThreadPool(self.jobs)
+        try:
+            projects = pool.map(self.get_project, names)
+        finally:
+            pool.close()
+            pool.join()
+        if self.cache:
+            self.cache.save()
+        results = {}
+        for project in projects:
+            if project:
+                results[project.name] = project
+        return results
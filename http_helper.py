@@ -0,0 +1,186 @@
+#!/usr/bin/python
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Copyright (C) 2014
+#    Richard Hughes <richard@hughsie.com>
+
+""" Helper object for HTTP requests """
+
+import hashlib
+import os
+import random
+import shutil
+import threading
+import time
+
+import requests
+import requests.adapters
+
+# internal
+from log import print_debug
+
+class HttpException(Exception):
+    pass
+
+class HttpHelper(object):
+    """ Helper object for HTTP requests
+
+    Connections are kept alive and reused for each host, and failed
+    requests are retried with an exponential backoff until either the
+    number of tries or the total time budget is used up.
+    """
+
+    def __init__(self, tries=8, backoff=1.0, backoff_max=60.0, budget=300.0,
+                 timeout=30, pool_size=16):
+        self.tries = tries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.budget = budget
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._local = threading.local()
+
+    def _get_session(self):
+        """ Returns the session for this thread """
+        session = getattr(self._local, 'session', None)
+        if session:
+            return session
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size,
+                                                pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        self._local.session = session
+        return session
+
+    def _get_delay(self, attempt):
+        """ Returns how long to wait before the next try, with full jitter """
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+    def request(self, method, url, headers=None, stream=False, timeout=None):
+        """ Sends a request, retrying on connection and server errors """
+        if not timeout:
+            timeout = self.timeout
+        session = self._get_session()
+        deadline = time.time() + self.budget
+        attempt = 0
+        while True:
+            try:
+                response = session.request(method, url, headers=headers,
+                                           stream=stream, timeout=timeout)
+                if response.status_code < 500 and response.status_code != 429:
+                    return response
+                error = "%s returned %i" % (url, response.status_code)
+                response.close()
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                error = "%s: %s" % (url, str(e))
+
+            # give up, or wait before trying again
+            attempt += 1
+            delay = self._get_delay(attempt)
+            if attempt >= self.tries or time.time() + delay > deadline:
+                raise HttpException(error)
+            print_debug("Retrying in %.1fs after try %i failed: %s" % (delay, attempt, error))
+            time.sleep(delay)
+
+    def get(self, url, headers=None, stream=False, timeout=None):
+        """ Sends a GET request """
+        return self.request('GET', url, headers, stream, timeout)
+
+    def head(self, url, headers=None, timeout=None):
+        """ Sends a HEAD request """
+        return self.request('HEAD', url, headers, False, timeout)
+
+    def download(self, url, filename, sha256=None, throttle=None, chunk_size=65536, partial=None):
+        """ Downloads a file, resuming any earlier partial download
+
+        The data is written to a temporary file, which is partial if set,
+        and is only moved to the final filename when complete and the
+        checksum matches.
+        """
+        tmp = partial or filename + '.part'
+        checksum = hashlib.sha256()
+        offset = 0
+
+        # hash what we already have
+        if os.path.exists(tmp):
+            with open(tmp, 'rb') as f:
+                while True:
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        break
+                    checksum.update(chunk)
+                    offset += len(chunk)
+            print_debug("Resuming download of %s at %i bytes" % (url, offset))
+
+        attempt = 0
+        while True:
+            headers = None
+            if offset > 0:
+                headers = {'Range': 'bytes=%i-' % offset}
+            response = self.get(url, headers=headers, stream=True)
+
+            # the partial file is already complete
+            if response.status_code == 416 and offset > 0:
+                response.close()
+                break
+
+            # the server might not support ranges
+            if response.status_code == 200:
+                checksum = hashlib.sha256()
+                offset = 0
+                mode = 'wb'
+            elif response.status_code == 206:
+                mode = 'ab'
+            else:
+                response.close()
+                raise HttpException("%s returned %i" % (url, response.status_code))
+
+            try:
+                with open(tmp, mode) as f:
+                    for chunk in response.iter_content(chunk_size):
+                        f.write(chunk)
+                        checksum.update(chunk)
+                        offset += len(chunk)
+                        if throttle:
+                            throttle.consume(len(chunk))
+                break
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout) as e:
+                attempt += 1
+                if attempt >= self.tries:
+                    raise HttpException("%s: %s" % (url, str(e)))
+                delay = self._get_delay(attempt)
+                print_debug("Resuming in %.1fs at %i bytes: %s" % (delay, offset, str(e)))
+                time.sleep(delay)
+
+        # never keep corrupt data around, as we would just resume it
+        if sha256 and checksum.hexdigest() != sha256:
+            os.remove(tmp)
+            raise HttpException("Checksum of %s was %s, expected %s" % (url, checksum.hexdigest(), sha256))
+        shutil.move(tmp, filename)
+
+_http_helper = None
+
+def get_http_helper():
+    """ Returns the HTTP helper shared by all the other helpers """
+    global _http_helper
+    if not _http_helper:
+        _http_helper = HttpHelper()
+    return _http_helper
@@ -20,9 +20,25 @@
 
 """ Helper object for Koji """
 
+import os
+import time
+
 import koji
 
 from package import Package
+from command_helper import run_command, get_log_path
+from cache_helper import JsonCache
+from log import print_debug, print_fail
+
+def _get_package(info):
+    """ Returns a 'Package' for an rpm or build from koji """
+    pkg = Package()
+    pkg.name = info['name']
+    if info.get('epoch') is not None:
+        pkg.epoch = str(info['epoch'])
+    pkg.version = info['version']
+    pkg.release = info['release']
+    return pkg
 
 class KojiHelper(object):
     """ Helper object for Koji """
@@ -30,15 +46,216 @@ class KojiHelper(object):
     def __init__(self):
         koji_instance = 'http://koji.fedoraproject.org/kojihub/'
         self.session = koji.ClientSession(koji_instance)
+        self.snapshots = {}
+
+    def get_tag_snapshot(self, tag, cachedir=None, ttl=3600):
+        """ Returns the newest builds of everything in a tag """
+        snapshot = self.snapshots.get(tag)
+        if not snapshot:
+            snapshot = KojiTagSnapshot(self, tag, cachedir, ttl)
+            self.snapshots[tag] = snapshot
+        return snapshot
 
     def get_newest_build(self, branch, pkgname):
         """ Returns the newest 'Package' for a given branch and package name """
         builds = self.session.getLatestRPMS(branch, package=pkgname, arch='src')
         if len(builds[0]) == 0:
             return None
-        latest = builds[0][0]
+        return _get_package(builds[0][0])
+
+    def _multicall(self, calls):
+        """ Runs a list of (method, args) in one round trip
+
+        Returns a list of results, with None for each call that failed.
+        """
+        if not calls:
+            return []
+        self.session.multicall = True
+        for method, args in calls:
+            getattr(self.session, method)(*args)
+        results = []
+        for result in self.session.multiCall():
+            if isinstance(result, dict):
+                results.append(None)
+            else:
+                results.append(result[0])
+        return results
+
+    def get_newest_builds(self, queries):
+        """ Returns the newest 'Package' for lots of (branch, pkgname) in one
+        round trip, with None for each one that does not exist """
+        calls = [('getLatestRPMS', (branch, pkgname, 'src')) for branch, pkgname in queries]
+        pkgs = []
+        for builds in self._multicall(calls):
+            if builds and builds[0]:
+                pkgs.append(_get_package(builds[0][0]))
+            else:
+                pkgs.append(None)
+        return pkgs
+
+    def get_builds(self, build_ids):
+        """ Returns the 'Package' for lots of build IDs in one round trip """
+        pkgs = []
+        for info in self._multicall([('getBuild', (build_id,)) for build_id in build_ids]):
+            if info:
+                pkgs.append(_get_package(info))
+            else:
+                pkgs.append(None)
+        return pkgs
+
+    def get_task_states(self, task_ids):
+        """ Returns the states of lots of tasks in one round trip """
+        results = self._multicall([('getTaskInfo', (task_id,)) for task_id in task_ids])
+        states = {}
+        for task_id, info in zip(task_ids, results):
+            if info:
+                states[task_id] = info['state']
+        return states
+
+class KojiTagSnapshot(object):
+    """ The newest source builds in a tag, fetched in one call
+
+    If cachedir is set the builds are saved to disk and used again by
+    later runs until they are older than ttl seconds.
+    """
+
+    def __init__(self, koji_helper, tag, cachedir=None, ttl=3600):
+        self.koji = koji_helper
+        self.tag = tag
+        self.builds = None
+        self.cache = None
+        if cachedir:
+            filename = os.path.join(cachedir, 'koji-%s.json' % tag)
+            self.cache = JsonCache(filename)
+            timestamp = self.cache.get('timestamp', 0)
+            if time.time() - timestamp < ttl:
+                self.builds = self.cache.get('builds')
+
+    def _load(self):
+        print_debug("Getting the newest builds in %s" % self.tag)
+
+        # only try once if koji is broken
+        self.builds = {}
+        rpms = self.koji.session.getLatestRPMS(self.tag, arch='src')[0]
+        for latest in rpms:
+            epoch = latest['epoch']
+            if epoch is not None:
+                epoch = str(epoch)
+            self.builds[latest['name']] = (epoch, latest['version'], latest['release'])
+        if self.cache:
+            self.cache.set('timestamp', time.time())
+            self.cache.set('builds', self.builds)
+            self.cache.save()
+
+    def get_newest_build(self, pkgname):
+        """ Returns the newest 'Package' for a package name, or None """
+        if self.builds is None:
+            self._load()
+        build = self.builds.get(pkgname)
+        if not build:
+            return None
         pkg = Package()
-        pkg.name = latest['name']
-        pkg.version = latest['version']
-        pkg.release = latest['release']
+        pkg.name = pkgname
+        pkg.epoch, pkg.version, pkg.release = build
         return pkg
+
+class KojiTaskWatcher(object):
+    """ Watches lots of koji tasks at the same time
+
+    A task is counted as failed if its state cannot be got for max_errors
+    polls in a row, so that nothing waits forever when koji is broken.
+    """
+
+    def __init__(self, koji_helper, interval=30, max_errors=10):
+        self.koji = koji_helper
+        self.interval = interval
+        self.max_errors = max_errors
+        self.tasks = {}
+        self.results = {}
+        self.errors = {}
+
+    def add(self, key, task_id):
+        """ Adds a task to watch, e.g. the build of a module """
+        self.tasks[key] = task_id
+        print_debug("Watching task %i for %s" % (task_id, key))
+
+    def is_pending(self, key):
+        return key in self.tasks
+
+    def poll(self):
+        """ Gets the states of every unfinished task in one round trip """
+        keys = list(self.tasks.keys())
+        try:
+            states = self.koji.get_task_states([self.tasks[key] for key in keys])
+        except Exception as e:
+            print_fail("Failed to get task states: %s" % str(e))
+            states = {}
+        for key in keys:
+            task_id = self.tasks[key]
+            state = states.get(task_id)
+
+            # give up on tasks koji cannot tell us about
+            if state is None:
+                self.errors[key] = self.errors.get(key, 0) + 1
+                if self.errors[key] < self.max_errors:
+                    continue
+                print_fail("Unable to get the state of task %i for %s" % (task_id, key))
+                self.results[key] = False
+            elif state == koji.TASK_STATES['CLOSED']:
+                print_debug("Task %i for %s succeeded" % (task_id, key))
+                self.results[key] = True
+            elif state in (koji.TASK_STATES['FAILED'], koji.TASK_STATES['CANCELED']):
+                print_fail("Task %i for %s failed" % (task_id, key))
+                self.results[key] = False
+            else:
+                self.errors.pop(key, None)
+                continue
+            self.errors.pop(key, None)
+            del self.tasks[key]
+
+    def wait(self, keys=None):
+        """ Waits for some or all of the tasks, returning False if any failed """
+        if keys is None:
+            keys = list(self.tasks.keys())
+        while True:
+            pending = [key for key in keys if key in self.tasks]
+            if not pending:
+                break
+            self.poll()
+            if [key for key in keys if key in self.tasks]:
+                time.sleep(self.interval)
+        for key in keys:
+            if not self.results.get(key, True):
+                return False
+        return True
+
+class KojiRepoWaiter(object):
+    """ Waits once for a build repo that has lots of new builds in it """
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.builds = {}
+
+    def add(self, key, nvr):
+        """ Adds a build that has to be in the repo """
+        self.builds[key] = nvr
+
+    def remove(self, key):
+        """ Removes a build, e.g. because it failed """
+        del self.builds[key]
+
+    def is_pending(self, key):
+        return key in self.builds
+
+    def get_keys(self):
+        return list(self.builds.keys())
+
+    def wait(self):
+        """ Waits for a repo containing all the builds """
+        if not self.builds:
+            return True
+        argv = ['koji', 'wait-repo', self.tag]
+        for nvr in sorted(self.builds.values()):
+            argv.extend(['--build', nvr])
+        self.builds = {}
+        return run_command(None, argv, log_path=get_log_path('koji-wait-repo'))
@@ -21,81 +21,16 @@
 """ A simple script that builds GNOME packages for COPR """
 
 import argparse
+import os
 
 # internal
 from log import print_debug, print_info, print_fail
 from modules import ModulesXml
+from srpm_helper import rebuild_srpms, remove_srpm
+from upload_helper import UploadStore
+from command_helper import setup_commands
 from koji_helper import KojiHelper
-from copr_helper import CoprHelper, CoprBuildStatus, CoprException
-
-def rebuild_srpm(pkg):
-    import shutil
-    import os
-    import urllib2
-    import subprocess
-
-    # create new /tmp/copr/pkgname
-    tmp_path = '/tmp/copr/' + pkg.name
-    if os.path.exists(tmp_path):
-        shutil.rmtree(tmp_path, True)
-    os.makedirs(tmp_path)
-
-    # download the package to /tmp
-    print_debug("Downloading SRPM from %s" % pkg.get_url())
-    response = urllib2.urlopen(pkg.get_url())
-    pkg_binary = response.read()
-    f = open(tmp_path + '/pkg.src.rpm', 'w')
-    f.write(pkg_binary)
-    f.close()
-
-    # explode the package with rpm2cpio
-    print_debug("Extracting SRPM to %s" % tmp_path)
-    p = subprocess.Popen(["rpm2cpio pkg.src.rpm | cpio --extract"],
-                         cwd=tmp_path, shell=True,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    p.wait()
-    out, err = p.communicate()
-    if p.returncode != 0:
-        print_fail(err)
-        return False
-
-    # bump the release tag
-    print_debug("Bumping revision and adding comment")
-    specfile = tmp_path + '/' + pkg.name + '.spec'
-    p = subprocess.Popen(["rpmdev-bumpspec",
-                         "-c Built for COPR",
-                         '-r',
-                         specfile])
-    p.wait()
-
-    # rebuild the package with rpmbuild -bs
-    print_debug("Building local package " + pkg.get_nvr())
-    p = subprocess.Popen(['rpmbuild',
-                         "--define=_sourcedir /tmp/copr/" + pkg.name,
-                         "--define=_srcrpmdir /tmp/copr/" + pkg.name,
-                         '-bs', specfile],
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    p.wait()
-    out, err = p.communicate()
-    if p.returncode != 0:
-        print_fail(err)
-        return False
-    new_srpm = out.replace('\n', '').split(' ')[1]
-
-    # upload the package somewhere shared
-    upload_dir = 'rhughes@fedorapeople.org:/home/fedora/rhughes/public_html/copr/'
-    print_debug("Uploading local package to " + upload_dir)
-    p = subprocess.Popen(['scp', '-q', new_srpm, upload_dir])
-    p.wait()
-
-    # over-ride this from the koji one
-    pkg.url = "http://rhughes.fedorapeople.org/copr/" + os.path.basename(new_srpm)
-
-    # delete our temp space
-    shutil.rmtree(tmp_path, True)
-    return True
+from copr_helper import CoprHelper, CoprBuildStatus, CoprException, CoprScheduler
 
 def main():
 
@@ -111,15 +46,29 @@ def main():
     parser.add_argument('--ignore-existing', action='store_true', help='Build the module even if it already exists in COPR')
     parser.add_argument('--ignore-version', action='store_true', help='Build the module even if the same version exists in the destination')
     parser.add_argument('--rebuild-srpm', action='store_true', help='Rebuild the package with a bumped release version')
+    parser.add_argument('--upload-dest', default="rhughes@fedorapeople.org:/home/fedora/rhughes/public_html/copr/", help='Where to upload rebuilt packages, either user@host:/path or a local directory')
+    parser.add_argument('--upload-url', default="http://rhughes.fedorapeople.org/copr/", help='The public URL of the upload destination')
+    parser.add_argument('--jobs', type=int, default=4, help='The number of packages to rebuild at once (default: 4)')
+    parser.add_argument('--max-builds', type=int, default=10, help='The maximum number of COPR builds at once (default: 10)')
+    parser.add_argument('--cache', default="cache", help='The cache of saved metadata')
+    parser.add_argument('--command-timeout', type=int, default=0, help='Kill any command without its own timeout running for longer than this in seconds (default: never)')
+    parser.add_argument('--koji-cache-ttl', type=int, default=600, help='How long to use the saved koji tag contents in seconds (default: 600)')
     args = parser.parse_args()
 
     # parse the configuration file
     data = ModulesXml(args.modules)
 
+    metadata_cache = os.path.join(args.cache, '.mclazy')
+    if not os.path.isdir(metadata_cache):
+        os.makedirs(metadata_cache)
+
+    # keep the output of each command in a log for the package
+    setup_commands(os.path.join(metadata_cache, 'logs'), args.command_timeout or None)
     koji = KojiHelper()
+    source = koji.get_tag_snapshot(args.branch_source, metadata_cache, args.koji_cache_ttl)
+    destination = koji.get_tag_snapshot(args.branch_destination, metadata_cache, args.koji_cache_ttl)
     copr = CoprHelper(args.copr_id)
-
-    current_depsolve_level = 0
+    scheduler = CoprScheduler(copr, args.max_builds, data.get_deps)
 
     # only build one module
     if args.buildone:
@@ -147,40 +96,41 @@ def main():
 
     # build one module, plus the things that depend on it
     if args.bump_soname:
+        root = data._get_item_by_pkgname(args.bump_soname)
+        if not root:
+            root = data._get_item_by_name(args.bump_soname)
+        wanted = set()
+        if root:
+            wanted.add(root)
+            wanted.update(data.get_rdeps(root.name))
         for item in data.items:
-            disabled = True
-            if item.pkgname == args.bump_soname:
-                disabled = False
-            else:
-                for dep in item.deps:
-                    if dep == args.bump_soname:
-                        disabled = False
-                        break
-            item.disabled = disabled
+            item.disabled = item not in wanted
 
+    # get the latest builds from koji
+    pkgs = []
     for item in data.items:
 
-        # wait for builds
-        if current_depsolve_level != item.depsolve_level:
-            rc = copr.wait_for_builds()
-            if not rc:
-                print_fail("A build failed, so aborting")
-                break
-            current_depsolve_level = item.depsolve_level
-            print_debug("Now running depsolve level %i" % current_depsolve_level)
-
         # skip
         if item.disabled:
             if not args.buildone:
                 print_debug("Skipping %s as disabled" % item.name)
             continue
 
-        # get the latest build from koji
-        pkg = koji.get_newest_build(args.branch_source, item.pkgname)
+        pkg = source.get_newest_build(item.pkgname)
         if not pkg:
             print_fail("package %s does not exists in %s" % (item.pkgname, args.branch_destination))
             continue
         print_debug("Latest version of %s in %s: %s" % (item.pkgname, args.branch_source, pkg.get_nvr()))
+        pkgs.append((item, pkg))
+
+    # find out what has been built in copr all at once
+    try:
+        copr.prefetch_pkg_status([pkg for item, pkg in pkgs])
+    except CoprException, e:
+        print_fail(str(e))
+
+    pending = []
+    for item, pkg in pkgs:
 
         # has this build been submitted?
         try:
@@ -208,28 +158,40 @@ def main():
             continue
 
         # does this version already exist?
-        pkg_stable = koji.get_newest_build(args.branch_destination, item.pkgname)
+        pkg_stable = destination.get_newest_build(item.pkgname)
         if pkg_stable:
             print_debug("Latest version in %s: %s" % (args.branch_destination, pkg_stable.get_nvr()))
             if not args.ignore_version and pkg.version == pkg_stable.version:
                 print_debug("Already exists same version")
                 continue
 
-        # this is expensive!
-        if args.rebuild_srpm:
-            if not rebuild_srpm(pkg):
-                continue
-
-        # submit to copr
+        # submit to copr once the deps are built
         print_debug("Submitting URL " + pkg.get_url())
         if args.simulate:
             continue
-        if not copr.build(pkg):
-            print_fail("build")
-            break
-
-    # final pass
-    rc = copr.wait_for_builds()
+        pending.append((item, pkg))
+
+    # this is expensive, so do lots at once
+    if args.rebuild_srpm:
+        srpms = rebuild_srpms([pkg for item, pkg in pending], args.jobs)
+        store = UploadStore(args.upload_dest, args.upload_url)
+        rebuilt = []
+        for (item, pkg), srpm in zip(pending, srpms):
+            if srpm:
+                pkg.url = store.add(srpm)
+                rebuilt.append((item, pkg))
+        if not store.upload():
+            print_fail("Failed to upload rebuilt packages")
+            rebuilt = []
+        for srpm in srpms:
+            if srpm:
+                remove_srpm(srpm)
+        pending = rebuilt
+    for item, pkg in pending:
+        scheduler.add(item.name, pkg, item.deps)
+
+    # build everything
+    rc = scheduler.run()
     if not rc:
         print_fail("Failed")
 
@@ -24,7 +24,7 @@ import rpm
 import argparse
 
 from log import print_debug, print_info, print_fail
-from copr_helper import CoprHelper, CoprBuildStatus, CoprException
+from copr_helper import CoprHelper, CoprBuildStatus, CoprException, CoprScheduler
 from koji_helper import KojiHelper
 from package import Package
 from modules import ModulesXml
@@ -35,6 +35,7 @@ def main():
     parser.add_argument('--branch-source', default="f21", help='The branch to use as a source')
     parser.add_argument('--copr-id', default="el7-gnome-3-14", help='The COPR to use')
     parser.add_argument('--packages', default="./data/el7-gnome-3-14.txt", help='the list if packages to build')
+    parser.add_argument('--max-builds', type=int, default=10, help='The maximum number of COPR builds at once (default: 10)')
     args = parser.parse_args()
 
     copr = CoprHelper(args.copr_id)
@@ -55,7 +56,7 @@ def main():
         if not item:
             print("%s not found" % pkgname)
             continue
-        item.releases.append(copr.release)
+        item.add_release(copr.release)
         item.custom_package_url = None
         if len(linedata) > 1:
             item.custom_package_url = linedata[1]
@@ -73,29 +74,25 @@ def main():
         print_fail("Failed to depsolve")
         return
 
-    # process all packages
-    current_depsolve_level = 0
-    for item in data.items:
-        if item.disabled:
-            continue;
-
-        # wait for builds
-        if current_depsolve_level != item.depsolve_level:
-            rc = copr.wait_for_builds()
-            if not rc:
-                print_fail("A build failed, so aborting")
-                break
-            current_depsolve_level = item.depsolve_level
-            print_debug("Now running depsolve level %i" % current_depsolve_level)
-
-        # find the koji package
+    # find the koji packages for both tags in one round trip
+    items = [item for item in data.items if not item.disabled]
+    queries = []
+    for item in items:
+        if not item.custom_package_url:
+            queries.append((args.branch_source, item.pkgname))
+            queries.append((args.branch_source + '-updates-candidate', item.pkgname))
+    newest = dict(zip(queries, koji.get_newest_builds(queries)))
+
+    # find the packages to build
+    pkgs = []
+    for item in items:
         pkg = None
         if not item.custom_package_url:
-            pkg = koji.get_newest_build(args.branch_source, item.pkgname)
+            pkg = newest[(args.branch_source, item.pkgname)]
             if not pkg:
                 print_fail("package %s does not exists in koji" % item.pkgname)
                 continue
-            pkg2 = koji.get_newest_build(args.branch_source + '-updates-candidate', item.pkgname)
+            pkg2 = newest[(args.branch_source + '-updates-candidate', item.pkgname)]
             if not pkg2:
                 print_fail("package %s does not exists in koji" % item.pkgname)
                 continue
@@ -111,7 +108,15 @@ def main():
             pkg.version = nvr[1]
             pkg.release = nvr[2].replace('.src.rpm', '')
             pkg.url = item.custom_package_url
-            
+        pkgs.append((item, pkg))
+
+    # process all packages
+    try:
+        copr.prefetch_pkg_status([pkg for item, pkg in pkgs])
+    except CoprException, e:
+        print_fail(str(e))
+    scheduler = CoprScheduler(copr, args.max_builds, data.get_deps)
+    for item, pkg in pkgs:
         print_debug("Latest version of %s: %s" % (item.pkgname, pkg.get_nvr()))
 
         # find if the package has been built in the copr
@@ -134,13 +139,11 @@ def main():
             print_fail("copr status unknown: %s" % status)
             continue
 
-        # submit build and wait for it to complete
-        if not copr.build(pkg):
-            print_fail("Failed to submit build")
-            break
+        # submit build once the deps are built
+        scheduler.add(item.name, pkg, item.deps)
 
-    # final pass
-    rc = copr.wait_for_builds()
+    # build everything
+    rc = scheduler.run()
     if not rc:
         print_fail("Failed")
 
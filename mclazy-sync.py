@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Copyright (C) 2014
+#    Richard Hughes <richard@hughsie.com>
+
+""" A simple script that updates all the checked out GNOME packages """
+
+import os
+import sys
+import argparse
+
+# internal
+from modules import ModulesXml, sync_pkgdirs, setup_distgit, get_distgit_host
+from ssh_helper import get_ssh_multiplexer
+from command_helper import setup_commands
+from log import print_info, print_fail
+
+def main():
+
+    # read defaults from command line arguments
+    parser = argparse.ArgumentParser(description='Update the checkouts of all the Fedora packages for a GNOME release')
+    parser.add_argument('--fedora-branch', default="rawhide", help='The fedora release to target (default: rawhide)')
+    parser.add_argument('--cache', default="cache", help='The cache of checked out packages')
+    parser.add_argument('--shallow', action='store_true', help='Only clone the latest commit of new checkouts')
+    parser.add_argument('--object-store', default=None, help='A directory of git objects shared with other caches')
+    parser.add_argument('--modules', default="modules.xml", help='The modules to search')
+    parser.add_argument('--buildone', default=None, help='Only sync one specific package')
+    parser.add_argument('--command-timeout', type=int, default=0, help='Kill any command without its own timeout running for longer than this in seconds (default: never)')
+    parser.add_argument('--jobs', type=int, default=8, help='The number of checkouts to sync at once (default: 8)')
+    args = parser.parse_args()
+
+    # create the cache directory if it's not already existing
+    if not os.path.isdir(args.cache):
+        os.mkdir(args.cache)
+
+    # keep the output of each command in a log for the package
+    setup_commands(os.path.join(args.cache, '.mclazy', 'logs'), args.command_timeout or None)
+
+    items = []
+    data = ModulesXml(args.modules)
+    for item in data.items:
+        if item.disabled:
+            continue
+        if args.buildone and args.buildone != item.name:
+            continue
+        items.append(item)
+
+    setup_distgit(args.cache)
+    if items:
+        # share one SSH connection to dist-git for every fetch and push
+        get_ssh_multiplexer().connect(get_distgit_host())
+    failed = sync_pkgdirs(items, args.cache, args.fedora_branch, args.jobs,
+                          args.shallow, args.object_store)
+    if failed:
+        print_fail("Failed to sync %i of %i checkouts" % (len(failed), len(items)))
+        sys.exit(1)
+    print_info("Done!")
+
+if __name__ == "__main__":
+    main()
@@ -21,38 +21,56 @@
 """ A simple script that builds GNOME packages for koji """
 
 import os
-import subprocess
-import urllib
-import json
 import re
 import rpm
 import argparse
-import fnmatch
 import glob
 
 # internal
-from modules import ModulesXml
+from modules import ModulesXml, sync_pkgdirs, setup_distgit, get_distgit_host
+from ssh_helper import get_ssh_multiplexer
+from command_helper import setup_commands
 from package import Package
+from gnome_helper import GnomeHelper
+from prefetch_helper import Prefetcher, Throttle
+from version_helper import VersionResolver
+from cache_helper import JsonCache
+from koji_helper import KojiHelper, KojiTaskWatcher, KojiRepoWaiter
+from spec_helper import update_spec, SpecEditError
+from upload_helper import UploadStore
 from log import print_debug, print_info, print_fail
 #from copr_helper import CoprHelper, CoprBuildStatus, CoprException
 
-def replace_spec_value(line, replace):
-    if line.find(' ') != -1:
-        return line.rsplit(' ', 1)[0] + ' ' + replace
-    if line.find('\t') != -1:
-        return line.rsplit('\t', 1)[0] + '\t' + replace
-    return line
-
-# first two digits of version
-def majorminor(ver):
-    v = ver.split('.')
-    return "%s.%s" % (v[0], v[1])
+def _get_tarball_func(gnome, item, project, version, throttle, download_dir):
+    """ Returns a function that downloads the tarball for a release
+
+    Partial downloads are kept in download_dir rather than the checkout,
+    which is cleaned on every run, so that the next run can resume them.
+    """
+    def _download():
+        tarball = project.get_tarball(version)
+        dest_tarball = os.path.join(item.pkg_cache, os.path.basename(tarball))
+        if os.path.exists(dest_tarball):
+            print_debug("Source %s already exists" % dest_tarball)
+            return
+        sha256 = gnome.get_tarball_checksum(project, version)
+        if not sha256:
+            print_debug("No checksum published for %s" % dest_tarball)
+        partial = os.path.join(download_dir, os.path.basename(tarball) + '.part')
+        gnome.http.download(gnome.get_project_url(item.name) + "/" + tarball,
+                            dest_tarball, sha256, throttle, partial=partial)
+    return _download
+
+def _get_koji_tag(fedora_branch):
+    """ Returns the koji tag holding the newest builds for a branch """
+    if fedora_branch == 'rawhide':
+        return 'rawhide'
+    if re.match(r'^f[0-9]+$', fedora_branch):
+        return fedora_branch + '-updates-candidate'
+    return None
 
 def main():
 
-    # use the main mirror
-    gnome_ftp = 'https://download.gnome.org/sources'
-
     # read defaults from command line arguments
     parser = argparse.ArgumentParser(description='Automatically build Fedora packages for a GNOME release')
     parser.add_argument('--fedora-branch', default="rawhide", help='The fedora release to target (default: rawhide)')
@@ -61,19 +79,45 @@ def main():
     parser.add_argument('--force-build', action='store_true', help='Always build even when not newer')
     parser.add_argument('--relax-version-checks', action='store_true', help='Relax checks on the version numbering')
     parser.add_argument('--cache', default="cache", help='The cache of checked out packages')
+    parser.add_argument('--shallow', action='store_true', help='Only clone the latest commit of new checkouts')
+    parser.add_argument('--object-store', default=None, help='A directory of git objects shared with other caches')
     parser.add_argument('--buildone', default=None, help='Only build one specific package')
     parser.add_argument('--buildroot', default=None, help='Use a custom buildroot, e.g. f18-gnome')
-    parser.add_argument('--bump-soname', default=None, help='Build any package that deps on this')
+    parser.add_argument('--bump-soname', default=None, help='Build any package that deps on this, directly or not')
     parser.add_argument('--copr-id', default=None, help='The COPR to optionally use')
+    parser.add_argument('--upload-dest', default=None, help='Where to upload COPR packages, either user@host:/path or a local directory')
+    parser.add_argument('--upload-url', default=None, help='The public URL of the upload destination')
+    parser.add_argument('--jobs', type=int, default=8, help='The number of parallel network requests (default: 8)')
+    parser.add_argument('--prefetch-depth', type=int, default=2, help='The number of tarballs to download ahead of the build (default: 2)')
+    parser.add_argument('--nowait', action='store_true', help='Do not wait for each build, only for the builds it depends on')
+    parser.add_argument('--plan', action='store_true', help='Only show the packages that need updating')
+    parser.add_argument('--koji-cache-ttl', type=int, default=600, help='How long to use the saved koji tag contents in seconds (default: 600)')
+    parser.add_argument('--command-timeout', type=int, default=0, help='Kill any command without its own timeout running for longer than this in seconds (default: never)')
+    parser.add_argument('--max-bandwidth', type=int, default=0, help='The maximum download speed in KiB/s (default: unlimited)')
     args = parser.parse_args()
 
+    upload_store = None
     if args.copr_id:
         copr = CoprHelper(args.copr_id)
+        upload_user = {'hughsie': 'rhughes', 'kalev': 'kalev'}.get(os.getenv('USERNAME'))
+        if args.upload_dest and args.upload_url:
+            upload_store = UploadStore(args.upload_dest, args.upload_url)
+        elif upload_user:
+            upload_store = UploadStore('%s@fedorapeople.org:/home/fedora/%s/public_html/copr/' % (upload_user, upload_user),
+                                       'http://%s.fedorapeople.org/copr/' % upload_user)
 
     # create the cache directory if it's not already existing
     if not os.path.isdir(args.cache):
         os.mkdir(args.cache)
 
+    # metadata that is not part of any package checkout
+    metadata_cache = os.path.join(args.cache, '.mclazy')
+    if not os.path.isdir(metadata_cache):
+        os.mkdir(metadata_cache)
+
+    # keep the output of each command in a log for the package
+    setup_commands(os.path.join(metadata_cache, 'logs'), args.command_timeout or None)
+
     # use rpm to check the installed version
     installed_pkgs = {}
     if args.check_installed:
@@ -86,12 +130,22 @@ def main():
 
     # parse the configuration file
     modules = []
-    data = ModulesXml('modules.xml')
+    data = ModulesXml('modules.xml', metadata_cache)
     if not args.buildone:
         print_debug("Depsolving moduleset...")
         if not data.depsolve():
             print_fail("Failed to depsolve")
             return
+
+
+    # everything that needs rebuilding, including things two or more hops away
+    if args.bump_soname:
+        affected = set([rdep.name for rdep in data.get_rdeps(args.bump_soname)])
+
+        # build a level at a time, but everything in a level at once
+        args.nowait = True
+
+    items = []
     for item in data.items:
 
         # ignore just this one module
@@ -103,9 +157,9 @@ def main():
             if args.buildone != item.name:
                 continue
 
-        # just things that have this as a dep
+        # just things that depend on this, directly or not
         if args.bump_soname:
-            if args.bump_soname not in item.deps:
+            if item.name not in affected:
                 continue
 
         # things we can't autobuild as we don't have upstream data files
@@ -116,6 +170,84 @@ def main():
         if args.copr_id:
             if not args.copr_id[10:] in item.branches:
                 continue
+        items.append(item)
+
+    # get the upstream versions of everything we might build
+    gnome = GnomeHelper(jobs=args.jobs, cachedir=metadata_cache)
+    projects = gnome.get_projects([item.name for item in items])
+
+    # find the newest upstream version of each module for this branch
+    candidates = {}
+    for item in items:
+        project = projects.get(item.name)
+        if project:
+            candidates[item.name] = (project.versions, item.release_glob[args.fedora_branch])
+    resolver = VersionResolver(relax=args.relax_version_checks)
+    newest_versions = resolver.get_newest_all(candidates)
+
+    # work out what needs updating without touching the checkouts
+    versions = JsonCache(os.path.join(metadata_cache, 'versions-%s.json' % args.fedora_branch))
+    koji_tag = _get_koji_tag(args.fedora_branch)
+    snapshot = None
+    planned = []
+    for item in items:
+        if not item.name in projects:
+            continue
+        newest_remote_version = newest_versions[item.name]
+        if not newest_remote_version:
+            print_fail("No remote versions of %s matching the gnome branch %s" %
+                       (item.name, item.release_glob[args.fedora_branch]))
+            print_fail("Check modules.xml is looking at the correct branch")
+            continue
+        if args.bump_soname or args.force_build:
+            planned.append(item)
+            continue
+
+        # the spec file version from the last time we looked
+        known_version = versions.get(item.pkgname)
+        if known_version:
+            rc = rpm.labelCompare((None, newest_remote_version, None), (None, known_version, None))
+            if rc <= 0:
+                continue
+
+        # somebody else might have already built it
+        if koji_tag:
+            if not snapshot:
+                snapshot = KojiHelper().get_tag_snapshot(koji_tag, metadata_cache, args.koji_cache_ttl)
+            try:
+                pkg = snapshot.get_newest_build(item.pkgname)
+            except Exception as e:
+                print_fail("Failed to get %s from koji: %s" % (item.pkgname, str(e)))
+                pkg = None
+            if pkg:
+                rc = rpm.labelCompare((None, newest_remote_version, None), (None, pkg.version, None))
+                if rc <= 0:
+                    versions.set(item.pkgname, pkg.version)
+                    continue
+        planned.append(item)
+    versions.save()
+
+    print_info("%i of %i packages need updating" % (len(planned), len(items)))
+    for item in planned:
+        print_debug("%s: %s -> %s" % (item.pkgname,
+                                      versions.get(item.pkgname, 'unknown'),
+                                      newest_versions[item.name]))
+    if args.plan:
+        return
+
+    # ensure the packages are checked out and up to date
+    setup_distgit(args.cache)
+    if planned:
+        # share one SSH connection to dist-git for every fetch and push
+        get_ssh_multiplexer().connect(get_distgit_host())
+    failed = sync_pkgdirs(planned, args.cache, args.fedora_branch, args.jobs,
+                          args.shallow, args.object_store)
+
+    spec_cache = JsonCache(os.path.join(metadata_cache, 'specs.json'))
+    updates = []
+    for item in planned:
+        if item.pkgname in failed:
+            continue
 
         # get started
         print_info("Loading %s" % item.name)
@@ -123,64 +255,15 @@ def main():
             print_debug("Package name: %s" % item.pkgname)
         print_debug("Version glob: %s" % item.release_glob[args.fedora_branch])
 
-        # ensure package is checked out
-        if not item.setup_pkgdir(args.cache, args.fedora_branch):
-            continue
-
         # get the current version from the spec file
-        if not item.parse_spec():
+        if not item.parse_spec(spec_cache):
             continue
 
         print_debug("Current version is %s" % item.version)
+        versions.set(item.pkgname, item.version)
 
-        # check for newer version on GNOME.org
-        success = False
-        for i in range (1, 20):
-            try:
-                urllib.urlretrieve ("%s/%s/cache.json" % (gnome_ftp, item.name), "%s/%s/cache.json" % (args.cache, item.pkgname))
-                success = True
-                break
-            except IOError as e:
-                print_fail("Failed to get JSON on try %i: %s" % (i, e))
-        if not success:
-            continue
-
-        new_version = None
-        gnome_branch = item.release_glob[args.fedora_branch]
-        local_json_file = "%s/%s/cache.json" % (args.cache, item.pkgname)
-        with open(local_json_file, 'r') as f:
-
-            # the format of the json file is as follows:
-            # j[0] = some kind of version number?
-            # j[1] = the files keyed for each release, e.g.
-            #        { 'pkgname' : {'2.91.1' : {u'tar.gz': u'2.91/gpm-2.91.1.tar.gz'} } }
-            # j[2] = array of remote versions, e.g.
-            #        { 'pkgname' : {  '3.3.92', '3.4.0' }
-            # j[3] = the LATEST-IS files
-            try:
-                j = json.loads(f.read())
-            except Exception, e:
-                print_fail("Failed to read JSON at %s: %s" % (local_json_file, str(e)))
-                continue
-
-            # find the newest version
-            newest_remote_version = '0'
-            for remote_ver in j[2][item.name]:
-                version_valid = False
-                for b in gnome_branch.split(','):
-                    if fnmatch.fnmatch(remote_ver, b):
-                        version_valid = True
-                        break
-                if not args.relax_version_checks and not version_valid:
-                    continue
-                rc = rpm.labelCompare((None, remote_ver, None), (None, newest_remote_version, None))
-                if rc > 0:
-                    newest_remote_version = remote_ver
-        if newest_remote_version == '0':
-            print_fail("No remote versions matching the gnome branch %s" % gnome_branch)
-            print_fail("Check modules.xml is looking at the correct branch")
-            continue
-
+        project = projects[item.name]
+        newest_remote_version = newest_versions[item.name]
         print_debug("Newest remote version is: %s" % newest_remote_version)
 
         # is this newer than the rpm spec file version
@@ -218,51 +301,58 @@ def main():
         # we need to update the package
         if new_version:
             print_debug("Need to update from %s to %s" %(item.version, new_version))
-
-        # download the tarball if it doesn't exist
+        updates.append((item, project, new_version))
+    versions.save()
+    spec_cache.save()
+
+    # download the new tarballs in the background while building
+    throttle = None
+    if args.max_bandwidth > 0:
+        throttle = Throttle(args.max_bandwidth * 1024)
+    download_dir = os.path.join(metadata_cache, 'downloads')
+    if not os.path.isdir(download_dir):
+        os.mkdir(download_dir)
+    prefetcher = Prefetcher(args.prefetch_depth)
+    for item, project, new_version in updates:
+        if new_version and not args.simulate:
+            prefetcher.add(item.name, _get_tarball_func(gnome, item, project, new_version, throttle, download_dir))
+
+    watcher = None
+    if args.nowait:
+        watcher = KojiTaskWatcher(KojiHelper())
+    repo_waiter = None
+    for item, project, new_version in updates:
+
+        print_info("Updating %s" % item.name)
+
+        # add the new source
         if new_version:
-            tarball = j[1][item.name][new_version]['tar.xz']
+            tarball = project.get_tarball(new_version)
             dest_tarball = tarball.split('/')[1]
-            if os.path.exists(item.pkgname + "/" + dest_tarball):
-                print_debug("Source %s already exists" % dest_tarball)
-            else:
-                tarball_url = gnome_ftp + "/" + item.name + "/" + tarball
-                print_debug("Download %s" % tarball_url)
-                if not args.simulate:
-                    try:
-                        urllib.urlretrieve (tarball_url, args.cache + "/" + item.pkgname + "/" + dest_tarball)
-                    except IOError as e:
-                        print_fail("Failed to get tarball: %s" % e)
-                        continue
-
-                    # add the new source
-                    item.new_tarball(dest_tarball)
-
-        # prep the spec file for rpmdev-bumpspec
-        if new_version:
-            with open(item.spec_filename, 'r') as f:
-                with open(item.spec_filename+".tmp", "w") as tmp_spec:
-                    for line in f:
-                        if line.startswith('Version:'):
-                            line = replace_spec_value(line, new_version + '\n')
-                        elif line.startswith('Release:'):
-                            line = replace_spec_value(line, '0%{?dist}\n')
-                        elif line.startswith(('Source:', 'Source0:')):
-                            line = re.sub("/" + majorminor(item.version) + "/",
-                                          "/" + majorminor(new_version) + "/",
-                                          line)
-                        tmp_spec.write(line)
-            os.rename(item.spec_filename + ".tmp", item.spec_filename)
-
-        # bump the spec file
+            print_debug("Waiting for %s" % dest_tarball)
+            if not args.simulate:
+                e = prefetcher.wait(item.name)
+                if e:
+                    print_fail("Failed to get tarball: %s" % e)
+                    continue
+                item.new_tarball(dest_tarball)
+
+        # update the spec file
         comment = None
         if args.bump_soname:
             comment = "Rebuilt for %s soname bump" % args.bump_soname
         elif new_version:
             comment = "Update to " + new_version
+        release = None
         if comment:
-            cmd = ['rpmdev-bumpspec', "--comment=%s" % comment, "%s.spec" % item.pkgname]
-            item.run_command(cmd)
+            try:
+                if new_version:
+                    release = update_spec(item.spec_filename, comment, new_version, item.version)
+                else:
+                    release = update_spec(item.spec_filename, comment, item.version)
+            except (IOError, SpecEditError) as e:
+                print_fail("Failed to update spec file: %s" % str(e))
+                continue
 
         # run prep, and make sure patches still apply
         if not args.simulate:
@@ -279,6 +369,9 @@ def main():
         if comment and not item.commit_and_push(comment):
             print_fail("push")
             continue
+        if new_version:
+            versions.set(item.pkgname, new_version)
+            versions.save()
 
         # COPR, so build srpm, upload and build
         if item.is_copr:
@@ -300,20 +393,13 @@ def main():
                 continue
 
             # upload the package somewhere shared
-            if os.getenv('USERNAME') == 'hughsie':
-                upload_dir = 'rhughes@fedorapeople.org:/home/fedora/rhughes/public_html/copr/'
-                upload_url = 'http://rhughes.fedorapeople.org/copr/'
-            elif os.getenv('USERNAME') == 'kalev':
-                upload_dir = 'kalev@fedorapeople.org:/home/fedora/kalev/public_html/copr/'
-                upload_url = 'http://kalev.fedorapeople.org/copr/'
-            else:
-                print_fail ("USERNAME not valid, ping hughsie on irc")
+            if not upload_store:
+                print_fail("No --upload-dest for COPR packages")
+                continue
+            pkg.url = upload_store.add(new_srpm)
+            if not upload_store.upload():
+                print_fail("Failed to upload %s" % new_srpm)
                 continue
-
-            print_debug("Uploading local package to " + upload_dir)
-            p = subprocess.Popen(['scp', '-q', new_srpm, upload_dir])
-            p.wait()
-            pkg.url = upload_url + os.path.basename(new_srpm)
 
             if not copr.build(pkg):
                 print_fail("COPR build")
@@ -349,7 +435,35 @@ def main():
             print_info("Building %s-%s-1.%s" % (item.pkgname, new_version, pkg_release_tag))
         else:
             print_info("Building %s-%s-1.%s" % (item.pkgname, item.version, pkg_release_tag))
-        if args.buildroot:
+
+        # wait once for a repo with all the builds this needs, even the
+        # ones only needed by modules that are not being rebuilt
+        all_deps = data.get_all_deps(item.deps)
+        if repo_waiter and [dep for dep in all_deps if repo_waiter.is_pending(dep)]:
+            if watcher:
+                keys = repo_waiter.get_keys()
+                watcher.wait(keys)
+
+                # never wait for a build that does not exist
+                for key in keys:
+                    if not watcher.results.get(key, True):
+                        print_fail("A dependency of %s failed to build" % item.pkgname)
+                        repo_waiter.remove(key)
+            if not repo_waiter.wait():
+                print_fail("Wait for repo")
+
+        if watcher:
+            # only wait for the builds this depends on
+            pending = [dep for dep in all_deps if watcher.is_pending(dep)]
+            if pending:
+                print_debug("Waiting for %s" % ', '.join(pending))
+                if not watcher.wait(pending):
+                    print_fail("A dependency of %s failed to build" % item.pkgname)
+            task_id = item.submit_build(args.buildroot)
+            rc = task_id is not None
+            if rc:
+                watcher.add(item.name, task_id)
+        elif args.buildroot:
             rc = item.run_command(['fedpkg', 'build', '--target', args.buildroot])
         else:
             rc = item.run_command(['fedpkg', 'build'])
@@ -379,11 +493,18 @@ def main():
             continue
 
         # wait for repo to sync
-        if item.wait_repo and args.fedora_branch == "rawhide":
-            rc = item.run_command(['koji', 'wait-repo', pkg_branch_name, '--build', "%s-%s-1.%s" % (item.pkgname, new_version, pkg_release_tag)])
-            if not rc:
-                print_fail("Wait for repo")
-                continue
+        if (item.wait_repo or args.bump_soname) and args.fedora_branch == "rawhide":
+            if not repo_waiter:
+                repo_waiter = KojiRepoWaiter(pkg_branch_name)
+            if not release:
+                release = '1%{?dist}'
+            repo_waiter.add(item.name, "%s-%s-%s" % (item.pkgname,
+                                                     new_version or item.version,
+                                                     release.replace('%{?dist}', '.' + pkg_release_tag)))
+
+    # wait for everything that was submitted
+    if watcher and not watcher.wait():
+        print_fail("Some builds failed")
 
 if __name__ == "__main__":
     main()
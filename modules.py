@@ -23,23 +23,98 @@
 import rpm
 import os
 import subprocess
+import multiprocessing
+import hashlib
+import re
+import cPickle
 
-from xml.etree.ElementTree import ElementTree
-from log import print_debug, print_info, print_fail
+from xml.etree.ElementTree import fromstring
+from log import print_info, print_fail
+from spec_helper import get_spec_version
+from command_helper import run_command, run_command_output, get_log_path
 
-def run_command(cwd, argv, print_failures=True):
-    print_debug("Running %s" % " ".join(argv))
-    p = subprocess.Popen(argv, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, error = p.communicate()
-    if p.returncode != 0 and print_failures:
-        print(output)
-        print(error)
-    if p.returncode != 0:
-        return False
-    return True
+DISTGIT_HOST = 'pkgs.fedoraproject.org'
+DISTGIT_URL = 'ssh://%s/rpms/%s.git'
+
+# the dist-git user that fedpkg pushes as, or None for the ssh default
+_distgit_user = None
+
+# the default gnome release numbers, shared by every item until changed
+DEFAULT_RELEASE_GLOB = {
+    'f23': "3.17.*,3.18.*,3.18",
+    'f24': "3.19.*,3.20.*,3.20",
+    'f25': "3.21.*,3.22.*,3.22",
+    'f26': "3.23.*,3.24.*,3.24",
+    'f27': "3.25.*,3.26.*,3.26",
+    'f28': "3.27.*,3.28.*,3.28",
+    'f29': "3.29.*,3.30.*,3.30",
+    'rawhide': "*",
+}
+DEFAULT_RELEASES = ('f23', 'f24', 'f25', 'f26', 'f27', 'f28', 'f29')
+DEFAULT_BRANCHES = ('3-12', '3-14')
+
+# the longest a git or fedpkg network operation may take, in seconds
+NETWORK_TIMEOUT = 1800
+
+# bump this when ModulesItem changes
+MODULES_CACHE_VERSION = 1
+
+def _get_modules_cache_version():
+    """ Returns a key that changes when the cache format or the defaults do """
+    defaults = repr((sorted(DEFAULT_RELEASE_GLOB.items()), DEFAULT_RELEASES, DEFAULT_BRANCHES))
+    return "%i:%s" % (MODULES_CACHE_VERSION, hashlib.sha1(defaults).hexdigest())
+
+def _get_checkout_user(cachedir):
+    """ Returns the user in the origin URL of any checkout made by fedpkg """
+    if not os.path.isdir(cachedir):
+        return None
+    prefix = 'ssh://'
+    for name in sorted(os.listdir(cachedir)):
+        config = os.path.join(cachedir, name, '.git', 'config')
+        if not os.path.exists(config):
+            continue
+        p = subprocess.Popen(['git', 'config', '--file', config, '--get', 'remote.origin.url'],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        url = p.communicate()[0].strip()
+        if url.startswith(prefix):
+            url = url[len(prefix):]
+        host = url.split('/')[0].split(':')[0]
+        if host == DISTGIT_HOST:
+            return None
+        if host.endswith('@' + DISTGIT_HOST):
+            return host.rsplit('@', 1)[0]
+    return None
+
+def setup_distgit(cachedir):
+    """ Finds the dist-git user from an existing checkout or ~/.fedora.upn """
+    global _distgit_user
+    _distgit_user = _get_checkout_user(cachedir)
+    if _distgit_user:
+        return
+    upn = os.path.expanduser('~/.fedora.upn')
+    if os.path.exists(upn):
+        with open(upn, 'r') as f:
+            _distgit_user = f.read().strip() or None
+
+def get_distgit_host():
+    """ Returns the [user@]host used for dist-git """
+    if _distgit_user:
+        return "%s@%s" % (_distgit_user, DISTGIT_HOST)
+    return DISTGIT_HOST
+
+def get_distgit_url(pkgname):
+    """ Returns the URL fedpkg would use for a package """
+    return DISTGIT_URL % (get_distgit_host(), pkgname)
 
 class ModulesItem(object):
     """ Represents a project in the modules.xml file """
+
+    __slots__ = ('name', 'pkgname', 'pkgconfig', 'pkg_cache', 'fedora_branch',
+                 'dist', 'releases', 'branches', 'wait_repo', 'disabled',
+                 'ftpadmin', 'release_glob', 'deps', 'depsolve_level',
+                 'is_copr', 'spec_filename', 'version', 'custom_package_url',
+                 '_release_glob_shared')
+
     def __init__(self):
         self.name = None
         self.pkgname = None
@@ -47,27 +122,38 @@ class ModulesItem(object):
         self.pkg_cache = None
         self.fedora_branch = None   # f20, rawhide, f20-gnome-3-12
         self.dist = None            # f20, master,  f20
-        self.releases = None
+        self.releases = DEFAULT_RELEASES
+        self.branches = DEFAULT_BRANCHES
         self.wait_repo = False
         self.disabled = False
         self.ftpadmin = True
-        self.release_glob = {}
-        self.deps = []
+        self.release_glob = DEFAULT_RELEASE_GLOB
+        self.deps = ()
         self.depsolve_level = 0
         self.is_copr = False
+        self.spec_filename = None
+        self.version = None
+        self.custom_package_url = None
+        self._release_glob_shared = True
+
+    def set_release_glob(self, release, value):
+        """ Sets the version glob for a release, copying the defaults first """
+        if self._release_glob_shared:
+            self.release_glob = dict(self.release_glob)
+            self._release_glob_shared = False
+        self.release_glob[release] = value
 
-        # add the default gnome release numbers
-        self.release_glob['f23'] = "3.17.*,3.18.*,3.18"
-        self.release_glob['f24'] = "3.19.*,3.20.*,3.20"
-        self.release_glob['f25'] = "3.21.*,3.22.*,3.22"
-        self.release_glob['f26'] = "3.23.*,3.24.*,3.24"
-        self.release_glob['f27'] = "3.25.*,3.26.*,3.26"
-        self.release_glob['f28'] = "3.27.*,3.28.*,3.28"
-        self.release_glob['f29'] = "3.29.*,3.30.*,3.30"
-        self.release_glob['rawhide'] = "*"
+    def add_release(self, release):
+        """ Adds a release this project should be built for """
+        if release not in self.releases:
+            self.releases = self.releases + (release,)
 
     def setup_pkgdir(self, cachedir, fedora_branch):
+        self.set_branch(cachedir, fedora_branch)
+        return self.sync_pkgdir()
 
+    def set_branch(self, cachedir, fedora_branch):
+        """ Sets up the paths and dist-git branch without touching the disk """
         self.spec_filename = "%s/%s/%s.spec" % (cachedir, self.pkgname, self.pkgname)
         self.fedora_branch = fedora_branch
         if self.fedora_branch == 'f20-gnome-3-12':
@@ -82,73 +168,164 @@ class ModulesItem(object):
             self.dist = 'master'
         else:
             self.dist = fedora_branch
+        self.pkg_cache = os.path.join(cachedir, self.pkgname)
+
+    def _sync_object_store(self, object_store):
+        """ Updates the bare repo shared by every checkout of this package """
+        store = os.path.abspath(os.path.join(object_store, self.pkgname + '.git'))
+        if not os.path.isdir(store):
+            if not self.run_command(['git', 'clone', '--mirror', get_distgit_url(self.pkgname), store], cwd=object_store, timeout=NETWORK_TIMEOUT):
+                print_fail("Create object store for %s" % self.pkgname)
+                return None
+        elif not self.run_command(['git', 'fetch', '--prune'], cwd=store, timeout=NETWORK_TIMEOUT):
+            return None
+        return store
+
+    def _clone(self, cachedir, shallow, store):
+        """ Creates a new checkout """
+        if not shallow and not store:
+            return self.run_command(["fedpkg", "co", self.pkgname], cwd=cachedir, timeout=NETWORK_TIMEOUT)
+        argv = ['git', 'clone']
+        if shallow and not self.is_copr:
+            argv.extend(['--depth', '1', '--single-branch', '--branch', self.dist])
+        if store:
+            argv.extend(['--reference', store])
+        argv.extend([get_distgit_url(self.pkgname), self.pkgname])
+        return self.run_command(argv, cwd=cachedir, timeout=NETWORK_TIMEOUT)
+
+    def sync_pkgdir(self, shallow=False, object_store=None):
+        """ Ensures the checkout is clean and up to date with the remote
+
+        If shallow is set then new checkouts only get the latest commit of
+        the branch. If object_store is set then the git objects are kept in
+        a bare repo that is shared with the checkouts of other branches.
+        """
+        cachedir = os.path.dirname(self.pkg_cache)
+        fedora_branch = self.fedora_branch
+
+        store = None
+        if object_store:
+            store = self._sync_object_store(object_store)
+            if not store:
+                return False
 
         # ensure package is checked out
-        self.pkg_cache = os.path.join(cachedir, self.pkgname)
         if not os.path.isdir(self.pkg_cache):
-            if not run_command(cachedir, ["fedpkg", "co", self.pkgname]):
+            if not self._clone(cachedir, shallow, store):
                 print_fail("Checkout %s" % self.pkgname)
                 return False
 
         # clean
-        if not run_command(self.pkg_cache, ['git', 'clean', '-dfx']):
+        if not self.run_command(['git', 'clean', '-dfx']):
             return False
-        if not run_command(self.pkg_cache, ['git', 'reset', '--hard', 'HEAD']):
+        if not self.run_command(['git', 'reset', '--hard', 'HEAD']):
             return False
-        if not run_command(self.pkg_cache, ['git', 'fetch']):
+
+        # the objects are already local if there is a store
+        if store:
+            argv = ['git', 'fetch', store, '+refs/heads/*:refs/remotes/origin/*']
+        elif os.path.exists(os.path.join(self.pkg_cache, '.git', 'shallow')):
+            # a shallow clone only tracks the branch it was cloned for, so
+            # track them all and fetch the one we want to switch to
+            if not self.run_command(['git', 'remote', 'set-branches', 'origin', '*']):
+                return False
+            if self.is_copr:
+                refspec = '+refs/heads/*:refs/remotes/origin/*'
+            else:
+                refspec = '+refs/heads/%s:refs/remotes/origin/%s' % (self.dist, self.dist)
+            argv = ['git', 'fetch', '--depth', '1', 'origin', refspec]
+        else:
+            argv = ['git', 'fetch']
+        if not self.run_command(argv, timeout=NETWORK_TIMEOUT):
             return False
 
         # private COPR branch
         do_pull = True
         if self.is_copr:
-            if not run_command(self.pkg_cache, ['git', 'checkout', fedora_branch], False):
-                if not run_command(self.pkg_cache, ['git', 'checkout', 'f20']):
+            if not self.run_command(['git', 'checkout', fedora_branch], print_failures=False):
+                if not self.run_command(['git', 'checkout', 'f20']):
                     return False
-                if not run_command(self.pkg_cache, ['git', 'checkout', '-b', fedora_branch]):
+                if not self.run_command(['git', 'checkout', '-b', fedora_branch]):
                     return False
-                if not self.run_command(['git', 'push', '--set-upstream', 'origin', fedora_branch]):
+                if not self.run_command(['git', 'push', '--set-upstream', 'origin', fedora_branch], timeout=NETWORK_TIMEOUT):
                     return False
                 do_pull = False
 
         # normal fedora branch e.g. f20, f19, rawhide etc.
-        elif not run_command(self.pkg_cache, ['git', 'checkout', self.dist]):
+        elif not self.run_command(['git', 'checkout', self.dist]):
             print_fail("Switch branch")
             return False
 
         # ensure package is updated
-        if do_pull and not run_command(self.pkg_cache, ['git', 'reset', '--hard', "origin/%s" % self.dist]):
+        if do_pull and not self.run_command(['git', 'reset', '--hard', "origin/%s" % self.dist]):
             print_fail("Update repo %s" % self.pkgname)
             return False
 
         return True
 
-    def parse_spec(self):
-        version = 0
+    def parse_spec(self, cache=None):
+        """ Gets the version from the spec file
+
+        The spec file is only parsed by rpm if the version cannot be found
+        by just scanning the file. If a cache is given then the results are
+        saved, keyed by the checksum of the spec file.
+        """
         if not os.path.exists(self.spec_filename):
             print_fail("No spec file")
             return False
+        with open(self.spec_filename, 'r') as f:
+            data = f.read()
+        checksum = hashlib.sha1(data).hexdigest()
+
+        # we've seen this exact file before
+        key = os.path.abspath(self.spec_filename)
+        if cache:
+            entry = cache.get(key)
+            if entry and entry['sha1'] == checksum:
+                self.version = entry['version']
+                return True
 
         # open spec file
-        try:
-            spec = rpm.spec(self.spec_filename)
-            self.version = spec.sourceHeader["version"]
-        except ValueError as e:
-            print_fail("Can't parse spec file")
-            return False
+        self.version = get_spec_version(data)
+        if not self.version:
+            try:
+                spec = rpm.spec(self.spec_filename)
+                self.version = spec.sourceHeader["version"]
+            except ValueError as e:
+                print_fail("Can't parse spec file")
+                return False
+        if cache:
+            cache.set(key, {'sha1': checksum, 'version': self.version})
         return True
 
-    def run_command(self, argv):
-        return run_command(self.pkg_cache, argv)
+    def run_command(self, argv, cwd=None, print_failures=True, timeout=None):
+        """ Runs a command in the checkout, logging the output for the package """
+        if not cwd:
+            cwd = self.pkg_cache
+        return run_command(cwd, argv, print_failures, get_log_path(self.pkgname), timeout)
 
     def check_patches(self):
         if self.is_copr:
             argv = ['fedpkg', "--dist=%s" % self.dist, 'prep']
         else:
             argv = ['fedpkg', 'prep']
-        return run_command(self.pkg_cache, argv)
+        return self.run_command(argv)
+
+    def submit_build(self, target=None):
+        """ Submits a koji build without waiting, returning the task ID """
+        argv = ['fedpkg', 'build', '--nowait']
+        if target:
+            argv.extend(['--target', target])
+        output = run_command_output(self.pkg_cache, argv, get_log_path(self.pkgname), NETWORK_TIMEOUT)
+        if not output:
+            return None
+        m = re.search(r'Created task: ([0-9]+)', output)
+        if not m:
+            return None
+        return int(m.group(1))
 
     def new_tarball(self, filename):
-        return run_command(self.pkg_cache, ['fedpkg', "--dist=%s" % self.dist, 'new-sources', filename])
+        return self.run_command(['fedpkg', "--dist=%s" % self.dist, 'new-sources', filename], timeout=NETWORK_TIMEOUT)
 
     def commit_and_push(self, commit_msg):
 
@@ -157,19 +334,105 @@ class ModulesItem(object):
             return False
 
         # private branch
-        if not self.run_command(['git', 'push']):
+        if not self.run_command(['git', 'push'], timeout=NETWORK_TIMEOUT):
             return False
         return True
 
+def _sync_pkgdir(args):
+    item, shallow, object_store = args
+    return (item.pkgname, item.sync_pkgdir(shallow, object_store))
+
+def sync_pkgdirs(items, cachedir, fedora_branch, jobs=8, shallow=False, object_store=None):
+    """ Syncs lots of checkouts in parallel, returning the ones that failed """
+    for item in items:
+        item.set_branch(cachedir, fedora_branch)
+    if object_store and not os.path.isdir(object_store):
+        os.makedirs(object_store)
+    print_info("Syncing %i checkouts" % len(items))
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.map(_sync_pkgdir, [(item, shallow, object_store) for item in items])
+    finally:
+        pool.close()
+        pool.join()
+    failed = []
+    for pkgname, success in results:
+        if not success:
+            print_fail("Failed to sync %s" % pkgname)
+            failed.append(pkgname)
+    return failed
+
 class ModulesXml(object):
-    """ Parses the modules.xml file """
-
-    def __init__(self, filename):
-        self.items = []
-        tree = ElementTree()
-        tree.parse(filename)
-        projects = list(tree.iter("project"))
-        for project in projects:
+    """ Parses the modules.xml file
+
+    If a cachedir is given then the parsed items are saved there, and are
+    reused for as long as the modules.xml file is not changed.
+    """
+
+    def __init__(self, filename, cachedir=None):
+        self.items = None
+        cache_filename = None
+        if cachedir:
+            cache_filename = os.path.join(cachedir, 'modules.cache')
+            self.items = self._load_cache(filename, cache_filename)
+        if self.items is None:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            self.items = self._parse(data)
+            if cache_filename:
+                self._save_cache(filename, cache_filename, data)
+        self._add_indexes()
+
+    def _add_indexes(self):
+        self._items_by_name = {}
+        self._items_by_pkgname = {}
+        self._items_by_pkgconfig = {}
+        self._rdeps = {}
+        for item in self.items:
+            self._items_by_name.setdefault(item.name, item)
+            self._items_by_pkgname.setdefault(item.pkgname, item)
+            self._items_by_pkgconfig.setdefault(item.pkgconfig, item)
+            for dep in item.deps:
+                self._rdeps.setdefault(dep, []).append(item)
+
+    def _load_cache(self, filename, cache_filename):
+        """ Returns the cached items, or None if they are out of date """
+        if not os.path.exists(cache_filename):
+            return None
+        try:
+            with open(cache_filename, 'rb') as f:
+                version, mtime, size, checksum, items = cPickle.load(f)
+        except Exception as e:
+            print_fail("Failed to load %s: %s" % (cache_filename, str(e)))
+            return None
+        if version != _get_modules_cache_version():
+            return None
+        st = os.stat(filename)
+        if st.st_mtime == mtime and st.st_size == size:
+            return items
+
+        # the file was touched, but might be the same
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if hashlib.sha1(data).hexdigest() != checksum:
+            return None
+        self._save_cache(filename, cache_filename, data, items)
+        return items
+
+    def _save_cache(self, filename, cache_filename, data, items=None):
+        if items is None:
+            items = self.items
+        st = os.stat(filename)
+        tmp = cache_filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            cPickle.dump((_get_modules_cache_version(), st.st_mtime, st.st_size,
+                          hashlib.sha1(data).hexdigest(), items),
+                         f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, cache_filename)
+
+    def _parse(self, data):
+        items = []
+        for project in fromstring(data).iter("project"):
             item = ModulesItem()
             item.disabled = False
             item.name = project.get('name')
@@ -185,96 +448,133 @@ class ModulesXml(object):
                 item.ftpadmin = False
             if project.get('disabled') == "True":
                 item.disabled = True
+            deps = []
             for data in project:
                 if data.tag == 'dep':
-                    item.deps.append(data.text)
+                    deps.append(data.text)
                 elif data.tag == 'release':
                     version = data.get('version')
-                    item.release_glob[version] = data.text
-            item.releases = []
+                    item.set_release_glob(version, data.text)
+            item.deps = tuple(deps)
             if project.get('releases'):
-                for release in project.get('releases').split(','):
-                    item.releases.append(release)
-            else:
-                item.releases.append('f23')
-                item.releases.append('f24')
-                item.releases.append('f25')
-                item.releases.append('f26')
-                item.releases.append('f27')
-                item.releases.append('f28')
-                item.releases.append('f29')
-            item.branches = []
+                item.releases = tuple(project.get('releases').split(','))
             if project.get('branches'):
-                for branch in project.get('branches').split(','):
-                    item.branches.append(branch)
-            else:
-                item.branches.append('3-12')
-                item.branches.append('3-14')
-            self.items.append(item)
+                item.branches = tuple(project.get('branches').split(','))
+            items.append(item)
+        return items
 
     def depsolve(self):
-        """ depsolves the list into the correct order """
+        """ depsolves the list into the correct order
 
-        # check there are no recyprical deps
-        for item in self.items:
+        Each enabled item ends up one level above the highest level of any
+        enabled item it depends on. Dependencies on disabled items are
+        ignored, and any other unknown dependency is an error.
+        """
+
+        # find the enabled deps of each enabled item
+        items = [item for item in self.items if not item.disabled]
+        deps = {}
+        rdeps = {}
+        for item in items:
+            deps[item] = set()
+            rdeps[item] = []
+        for item in items:
             for dep in item.deps:
-                item2 = self._get_item_by_name(dep)
-                if not item2:
+                item_dep = self._items_by_name.get(dep)
+                if item_dep and item_dep.disabled:
                     continue
-                if item.pkgname in item2.deps:
-                    print item.pkgname, "depends on", item2.pkgname
-                    print item2.pkgname, "depends on", item.pkgname
+                if not item_dep:
+                    print("failed to find dep %s" % dep)
                     return False
-
-        # do the depsolve
-        changes = True
-        cnt = 0
-        while changes:
-            if cnt > 10000:
-                print "Depsolve error"
-                self.items = sorted(self.items, key=lambda item: item.depsolve_level)
-                for item in self.items:
-                    if item.name:
-                        print item.name, item.depsolve_level
-                    else:
-                        print item.pkgname, item.depsolve_level
-                    for dep in item.deps:
-                        print "  ", dep, self._get_item_by_name(dep).depsolve_level
-                return False
-            changes = False
-            for item in self.items:
-                if item.disabled:
+                if item_dep in deps[item]:
                     continue
-                for dep in item.deps:
-                    item_dep = self._get_item_by_name(dep)
-                    if item_dep.disabled:
-                        continue
-                    if not item_dep:
-                        print "failed to find dep", dep
-                        return False
-                    if item.depsolve_level <= item_dep.depsolve_level:
-                        item.depsolve_level += 1
-                        changes = True
-                        cnt = cnt + 1
-                        break
-                if changes:
-                    break
+                deps[item].add(item_dep)
+                rdeps[item_dep].append(item)
+
+        # add each item once everything it depends on has been added
+        pending = {}
+        queue = []
+        for item in items:
+            item.depsolve_level = 0
+            pending[item] = len(deps[item])
+            if pending[item] == 0:
+                queue.append(item)
+        for item in queue:
+            for item_rdep in rdeps[item]:
+                if item_rdep.depsolve_level <= item.depsolve_level:
+                    item_rdep.depsolve_level = item.depsolve_level + 1
+                pending[item_rdep] -= 1
+                if pending[item_rdep] == 0:
+                    queue.append(item_rdep)
+
+        # anything left over is in, or depends on, a cycle
+        if len(queue) != len(items):
+            print("Depsolve error, cycle found: %s" % " -> ".join(self._find_cycle(deps, pending)))
+            return False
+
         # sort by depsolve key
         self.items = sorted(self.items, key=lambda item: item.depsolve_level)
         return True
 
+    def get_deps(self, name):
+        """ Returns the names of the modules that name depends on """
+        item = self._items_by_name.get(name)
+        if not item:
+            return ()
+        return item.deps
+
+    def get_all_deps(self, deps):
+        """ Returns the names of everything in deps and what they depend on """
+        found = set()
+        todo = list(deps)
+        while todo:
+            dep = todo.pop()
+            if dep in found:
+                continue
+            found.add(dep)
+            todo.extend(self.get_deps(dep))
+        return found
+
+    def get_rdeps(self, name):
+        """ Returns every item that depends on name, directly or not """
+        found = set()
+        rdeps = []
+        todo = [name]
+        while todo:
+            for item in self._rdeps.get(todo.pop(), []):
+                if item in found:
+                    continue
+                found.add(item)
+                rdeps.append(item)
+                todo.append(item.name)
+        return rdeps
+
+    def _find_cycle(self, deps, pending):
+        """ Returns the names of the items in a dependency cycle """
+        item = None
+        for item in pending:
+            if pending[item] > 0:
+                break
+        path = []
+        seen = {}
+        while item not in seen:
+            seen[item] = len(path)
+            path.append(item.name)
+            for item_dep in deps[item]:
+                if pending[item_dep] > 0:
+                    item = item_dep
+                    break
+        return path[seen[item]:] + [item.name]
+
     def _print(self):
         for item in self.items:
             print("%02i " % item.depsolve_level + ' ' * item.depsolve_level + item.pkgname)
 
     def _get_item_by_name(self, name):
-        for item in self.items:
-            if item.name == name:
-                return item
-        return None
+        return self._items_by_name.get(name)
 
     def _get_item_by_pkgname(self, name):
-        for item in self.items:
-            if item.pkgname == name:
-                return item
-        return None
+        return self._items_by_pkgname.get(name)
+
+    def _get_item_by_pkgconfig(self, name):
+        return self._items_by_pkgconfig.get(name)
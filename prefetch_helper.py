@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Copyright (C) 2014
+#    Richard Hughes <richard@hughsie.com>
+
+""" Helper objects for downloading in the background """
+
+import Queue
+import threading
+import time
+
+class Throttle(object):
+    """ Limits the bandwidth shared by all the downloads using it """
+
+    def __init__(self, rate):
+        self.rate = float(rate)     # bytes per second
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """ Blocks until it is okay to have used nbytes more """
+        with self._lock:
+            now = time.time()
+            self._next = max(now, self._next) + nbytes / self.rate
+            delay = self._next - now
+        if delay > 0:
+            time.sleep(delay)
+
+class PrefetchJob(object):
+    """ A job that is run ahead of the result being needed """
+
+    def __init__(self, key, func):
+        self.key = key
+        self.func = func
+        self.error = None
+        self.done = threading.Event()
+
+class Prefetcher(object):
+    """ Runs jobs in order, at most depth of them ahead of the consumer
+
+    Every job that is added has to be collected with wait(), otherwise
+    the prefetcher stops running more jobs.
+    """
+
+    def __init__(self, depth=2):
+        self.depth = max(depth, 1)
+        self._slots = threading.Semaphore(self.depth)
+        self._queue = Queue.Queue()
+        self._jobs = {}
+        for i in range(self.depth):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+
+    def _worker(self):
+        while True:
+            self._slots.acquire()
+            job = self._queue.get()
+            try:
+                job.func()
+            except Exception as e:
+                job.error = e
+            job.done.set()
+
+    def add(self, key, func):
+        """ Adds a job to the end of the queue """
+        job = PrefetchJob(key, func)
+        self._jobs[key] = job
+        self._queue.put(job)
+
+    def wait(self, key):
+        """ Waits for a job to finish, returning the exception if it failed """
+        job = self._jobs.pop(key)
+        while not job.done.wait(1):
+            pass
+        self._slots.release()
+        return job.error
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Copyright (C) 2014
+#    Richard Hughes <richard@hughsie.com>
+
+""" Reads and edits spec files without running rpm tools """
+
+import os
+import pwd
+import re
+import socket
+import time
+
+import rpm
+
+_define_re = re.compile(r'^%(global|define)\s+(\w+)\s+(.*)$')
+_tag_re = re.compile(r'^(Name|Version)\s*:\s*(.*)$', re.IGNORECASE)
+_macro_re = re.compile(r'%\{(\??)(\w+)\}|%(\w+)')
+_release_re = re.compile(r'^((?:[0-9]+\.)*)([0-9]+)(.*)$')
+_macro_span_re = re.compile(r'%\{[^}]*\}')
+_number_re = re.compile(r'[0-9]+')
+
+class SpecEditError(Exception):
+    pass
+
+def _expand(value, macros):
+    """ Expands simple macros, returning None if any are left over """
+    for i in range(10):
+        if value.find('%') == -1:
+            return value
+        unknown = []
+        def _replace(m):
+            if m.group(3):
+                name = m.group(3)
+                optional = False
+            else:
+                name = m.group(2)
+                optional = m.group(1) == '?'
+            if name in macros and macros[name] is not None:
+                return macros[name]
+            if optional and name not in macros:
+                return ''
+            unknown.append(name)
+            return m.group(0)
+        value = _macro_re.sub(_replace, value)
+        if unknown:
+            return None
+    return None
+
+def get_spec_version(data):
+    """ Returns the Version of a spec file, or None if rpm has to parse it
+
+    Only the preamble is scanned, and only %global and %define of simple
+    values are understood. Anything defined inside a conditional is
+    treated as unknown.
+    """
+    macros = {}
+    conditionals = 0
+    for line in data.splitlines():
+        line = line.strip()
+        if line.startswith('%if'):
+            conditionals += 1
+            continue
+        if line.startswith('%endif'):
+            conditionals -= 1
+            continue
+        if line.startswith(('%description', '%package', '%prep')):
+            break
+        m = _define_re.match(line)
+        if m:
+            if conditionals > 0:
+                macros[m.group(2)] = None
+            else:
+                macros[m.group(2)] = m.group(3).strip()
+            continue
+        m = _tag_re.match(line)
+        if not m:
+            continue
+        if conditionals > 0:
+            return None
+        value = _expand(m.group(2).strip(), macros)
+        if m.group(1).lower() == 'name':
+            macros['name'] = value
+        else:
+            return value
+    return None
+
+def replace_spec_value(line, replace):
+    if line.find(' ') != -1:
+        return line.rsplit(' ', 1)[0] + ' ' + replace
+    if line.find('\t') != -1:
+        return line.rsplit('\t', 1)[0] + '\t' + replace
+    return line
+
+# first two digits of version
+def majorminor(ver):
+    v = ver.split('.')
+    return "%s.%s" % (v[0], v[1])
+
+def bump_release(release, rightmost=False):
+    """ Increments the release number, e.g. 0.2.beta%{?dist} -> 0.3.beta%{?dist}
+
+    If rightmost is set then the last number outside of any macro is
+    incremented instead, like rpmdev-bumpspec -r, e.g. 2%{?dist}.1 ->
+    2%{?dist}.2, so the result stays older than the next real build.
+    """
+    if rightmost:
+        macros = [m.span() for m in _macro_span_re.finditer(release)]
+        numbers = [m for m in _number_re.finditer(release)
+                   if not [span for span in macros if span[0] <= m.start() < span[1]]]
+        if not numbers:
+            raise SpecEditError("Cannot bump release %s" % release)
+        m = numbers[-1]
+        return release[:m.start()] + str(int(m.group(0)) + 1) + release[m.end():]
+    m = _release_re.match(release)
+    if not m:
+        raise SpecEditError("Cannot bump release %s" % release)
+    return m.group(1) + str(int(m.group(2)) + 1) + m.group(3)
+
+def get_packager():
+    """ Returns the name and email address to use in the changelog """
+    packager = os.getenv('RPM_PACKAGER')
+    if packager:
+        return packager
+    packager = rpm.expandMacro('%{?packager}')
+    if packager:
+        return packager
+    user = pwd.getpwuid(os.getuid())
+    name = user.pw_gecos.split(',')[0] or user.pw_name
+    return "%s <%s@%s>" % (name, user.pw_name, socket.getfqdn())
+
+def update_spec(filename, comment, version, old_version=None, packager=None, rightmost=False):
+    """ Bumps the release and adds a changelog entry in one pass
+
+    If old_version is given then the package is also being updated to a new
+    upstream version, so the Version is changed, the Release is reset and
+    the Source URL is moved to the new directory. Otherwise the release is
+    bumped, using the rightmost number if rightmost is set. The file is
+    replaced atomically and the new Release value is returned.
+    """
+    if not packager:
+        packager = get_packager()
+    with open(filename, 'r') as f:
+        lines = f.readlines()
+
+    epoch = None
+    release = None
+    changelog = None
+    for i in range(len(lines)):
+        line = lines[i]
+        if line.startswith('Epoch:'):
+            epoch = line.split(':', 1)[1].strip()
+        elif line.startswith('Version:') and old_version:
+            lines[i] = replace_spec_value(line, version + '\n')
+        elif line.startswith('Release:') and release is None:
+            if old_version:
+                release = '1%{?dist}'
+            else:
+                release = bump_release(line.split(':', 1)[1].strip(), rightmost)
+            lines[i] = replace_spec_value(line, release + '\n')
+        elif line.startswith(('Source:', 'Source0:')) and old_version:
+            lines[i] = re.sub("/" + majorminor(old_version) + "/",
+                              "/" + majorminor(version) + "/",
+                              line)
+        elif line.startswith('%changelog') and changelog is None:
+            changelog = i
+    if release is None:
+        raise SpecEditError("No Release in %s" % filename)
+    if changelog is None:
+        raise SpecEditError("No %%changelog in %s" % filename)
+
+    # add the new entry to the top of the changelog
+    evr = "%s-%s" % (version, release.replace('%{?dist}', ''))
+    if epoch:
+        evr = "%s:%s" % (epoch, evr)
+    entry = "* %s %s - %s\n- %s\n\n" % (time.strftime('%a %b %d %Y'), packager, evr, comment)
+    lines.insert(changelog + 1, entry)
+
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        f.writelines(lines)
+    os.rename(tmp, filename)
+    return release
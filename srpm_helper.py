@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Copyright (C) 2014
+#    Richard Hughes <richard@hughsie.com>
+
+""" Rebuilds source packages with a bumped release """
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+from multiprocessing.pool import ThreadPool
+
+# internal
+from log import print_debug, print_fail
+from http_helper import get_http_helper, HttpException
+from spec_helper import update_spec, SpecEditError
+from command_helper import run_command_output, get_log_path
+
+def _extract(srpm, cwd):
+    """ Runs rpm2cpio into cpio without using a shell """
+    rpm2cpio = subprocess.Popen(['rpm2cpio', srpm], cwd=cwd,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    cpio = subprocess.Popen(['cpio', '--extract', '--quiet', '--no-absolute-filenames'],
+                            cwd=cwd, stdin=rpm2cpio.stdout,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    # let rpm2cpio get SIGPIPE if cpio exits early
+    rpm2cpio.stdout.close()
+    out, err = cpio.communicate()
+    rpm2cpio.wait()
+    if rpm2cpio.returncode != 0:
+        print_fail(rpm2cpio.stderr.read())
+        return False
+    if cpio.returncode != 0:
+        print_fail(err)
+        return False
+    return True
+
+def rebuild_srpm(pkg, comment='Built for COPR'):
+    """ Rebuilds the source package of a 'Package' with a bumped release
+
+    The work is done in a new scratch directory so that lots of packages
+    can be rebuilt at the same time. Returns the filename of the new source
+    package, which is in the scratch directory, or None for failure.
+    """
+    tmp_path = tempfile.mkdtemp(prefix='mclazy-%s-' % pkg.name)
+    srpm = os.path.join(tmp_path, os.path.basename(pkg.get_url()))
+    new_srpm = None
+    try:
+        print_debug("Downloading SRPM from %s" % pkg.get_url())
+        try:
+            get_http_helper().download(pkg.get_url(), srpm)
+        except (HttpException, IOError) as e:
+            print_fail("Failed to download %s: %s" % (pkg.get_url(), str(e)))
+            return None
+
+        print_debug("Extracting SRPM to %s" % tmp_path)
+        if not _extract(srpm, tmp_path):
+            return None
+        os.remove(srpm)
+
+        print_debug("Bumping revision and adding comment")
+        specfile = os.path.join(tmp_path, pkg.name + '.spec')
+        try:
+            update_spec(specfile, comment, pkg.version, rightmost=True)
+        except (SpecEditError, IOError) as e:
+            print_fail("Failed to update %s: %s" % (specfile, str(e)))
+            return None
+
+        print_debug("Building local package " + pkg.get_nvr())
+        output = run_command_output(tmp_path, ['rpmbuild',
+                                               '--define', '_sourcedir ' + tmp_path,
+                                               '--define', '_srcrpmdir ' + tmp_path,
+                                               '-bs', specfile],
+                                    get_log_path(pkg.name))
+        if output is None:
+            return None
+        for line in output.splitlines():
+            if line.startswith('Wrote:'):
+                new_srpm = line.split(':', 1)[1].strip()
+        if not new_srpm:
+            print_fail("No source package written for %s" % pkg.get_nvr())
+        return new_srpm
+    finally:
+        # keep the scratch directory only when it has the new package
+        if not new_srpm:
+            shutil.rmtree(tmp_path, True)
+
+def rebuild_srpms(pkgs, jobs=4):
+    """ Rebuilds lots of source packages at the same time, returning a list
+    of filenames, or None for each one that failed """
+    if not pkgs:
+        return []
+    pool = ThreadPool(min(jobs, len(pkgs)))
+    try:
+        return pool.map(rebuild_srpm, pkgs)
+    finally:
+        pool.close()
+        pool.join()
+
+def remove_srpm(srpm):
+    """ Removes a rebuilt source package and its scratch directory """
+    shutil.rmtree(os.path.dirname(srpm), True)
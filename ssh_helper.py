@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Copyright (C) 2014
+#    Richard Hughes <richard@hughsie.com>
+
+""" Shares one SSH connection per host for the whole run """
+
+import atexit
+import os
+import pipes
+import shutil
+import subprocess
+import tempfile
+import urlparse
+
+# internal
+from log import print_debug
+
+def get_ssh_host(url):
+    """ Returns the [user@]host of an ssh:// URL or a user@host:/path target """
+    if url.startswith('ssh://'):
+        return urlparse.urlparse(url).netloc.split(':')[0]
+    if url.find(':') == -1 or url.find('/') < url.find(':'):
+        return None
+    return url.split(':', 1)[0]
+
+class SshMultiplexer(object):
+    """ Shares one SSH connection per host for the whole run
+
+    A master connection is started in the background for each host, and
+    git, rsync and scp are told to send everything through it using the
+    GIT_SSH_COMMAND and RSYNC_RSH environment variables. If a master
+    cannot be started the commands just make their own connections.
+    """
+
+    def __init__(self):
+        self.tmpdir = None
+        self.hosts = set()
+
+    def _get_control_path(self):
+        return os.path.join(self.tmpdir, '%r@%h:%p')
+
+    def get_options(self):
+        """ Returns the options to use the shared connections """
+        return ['-o', 'ControlMaster=auto',
+                '-o', 'ControlPath=' + self._get_control_path()]
+
+    def install(self):
+        """ Makes all child processes use the shared connections """
+        if self.tmpdir:
+            return
+        self.tmpdir = tempfile.mkdtemp(prefix='mclazy-ssh-')
+        command = ' '.join(['ssh'] + [pipes.quote(opt) for opt in self.get_options()])
+        os.environ['GIT_SSH_COMMAND'] = command
+        os.environ['RSYNC_RSH'] = command
+        atexit.register(self.close)
+
+    def connect(self, host):
+        """ Starts the master connection to a host """
+        if not host or host in self.hosts:
+            return
+        self.install()
+        self.hosts.add(host)
+
+        # the master must not hold on to the output of anything we run
+        print_debug("Starting shared SSH connection to %s" % host)
+        argv = ['ssh', '-M', '-N', '-f', '-o', 'ControlPersist=yes']
+        argv.extend(self.get_options())
+        argv.append(host)
+        with open(os.devnull, 'w') as devnull:
+            if subprocess.call(argv, stdout=devnull, stderr=devnull) != 0:
+                print_debug("Failed to start shared SSH connection to %s" % host)
+
+    def close(self):
+        """ Stops all the master connections """
+        if not self.tmpdir:
+            return
+        with open(os.devnull, 'w') as devnull:
+            for host in self.hosts:
+                argv = ['ssh', '-O', 'exit']
+                argv.extend(self.get_options())
+                argv.append(host)
+                subprocess.call(argv, stdout=devnull, stderr=devnull)
+        shutil.rmtree(self.tmpdir, True)
+        self.tmpdir = None
+        self.hosts = set()
+
+_ssh_multiplexer = None
+
+def get_ssh_multiplexer():
+    """ Returns the SSH multiplexer shared by the whole run """
+    global _ssh_multiplexer
+    if not _ssh_multiplexer:
+        _ssh_multiplexer = SshMultiplexer()
+    return _ssh_multiplexer
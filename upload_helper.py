@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Copyright (C) 2014
+#    Richard Hughes <richard@hughsie.com>
+
+""" Uploads files somewhere shared, once per unique content """
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+# internal
+from log import print_debug, print_fail
+from command_helper import run_command, get_log_path
+from modules import NETWORK_TIMEOUT
+from ssh_helper import get_ssh_multiplexer, get_ssh_host
+
+def _get_checksum(filename, chunk_size=65536):
+    checksum = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+class UploadStore(object):
+    """ Uploads files somewhere shared, once per unique content
+
+    Files are stored as <dest>/<sha256>/<basename>, so a file that has
+    already been uploaded is never sent again, even by another run. The
+    destination is either a local directory or an rsync target such as
+    user@host:/path, and everything added is sent in one transfer.
+    """
+
+    def __init__(self, dest, url):
+        self.dest = dest.rstrip('/') + '/'
+        self.url = url.rstrip('/') + '/'
+        self.files = {}
+
+    def _is_remote(self):
+        return self.dest.find(':') != -1 and not os.path.isdir(self.dest)
+
+    def add(self, filename):
+        """ Adds a file to upload, returning the URL it will have """
+        path = os.path.join(_get_checksum(filename), os.path.basename(filename))
+        self.files[path] = filename
+        return self.url + path
+
+    def _upload_local(self):
+        for path in sorted(self.files):
+            dest = os.path.join(self.dest, path)
+            if os.path.exists(dest):
+                print_debug("Already uploaded %s" % path)
+                continue
+            try:
+                dirname = os.path.dirname(dest)
+                if not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                shutil.copy(self.files[path], dest + '.tmp')
+                os.rename(dest + '.tmp', dest)
+            except (IOError, OSError) as e:
+                print_fail("Failed to copy %s: %s" % (path, str(e)))
+                return False
+        return True
+
+    def _upload_remote(self):
+        # stage links to the files using the same layout as the destination
+        stage = tempfile.mkdtemp(prefix='mclazy-upload-')
+        try:
+            dirs = set()
+            for path in self.files:
+                dirname = os.path.join(stage, os.path.dirname(path))
+                if not os.path.isdir(dirname):
+                    os.mkdir(dirname)
+                os.symlink(os.path.abspath(self.files[path]), os.path.join(stage, path))
+                dirs.add(dirname)
+            get_ssh_multiplexer().connect(get_ssh_host(self.dest))
+            argv = ['rsync', '--recursive', '--copy-links', '--ignore-existing',
+                    '--perms', '--chmod=D755,F644']
+            argv.extend(sorted(dirs))
+            argv.append(self.dest)
+            return run_command(None, argv, log_path=get_log_path('upload'), timeout=NETWORK_TIMEOUT)
+        finally:
+            shutil.rmtree(stage, True)
+
+    def upload(self):
+        """ Uploads everything that has been added, returning False for failure """
+        if not self.files:
+            return True
+        print_debug("Uploading %i files to %s" % (len(self.files), self.dest))
+        if self._is_remote():
+            rc = self._upload_remote()
+        else:
+            rc = self._upload_local()
+        if rc:
+            self.files = {}
+        return rc
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Copyright (C) 2014
+#    Richard Hughes <richard@hughsie.com>
+
+""" Finds the newest upstream versions matching a release glob """
+
+import fnmatch
+import re
+
+_segment_re = re.compile(r'([0-9]+|[a-zA-Z]+|~|\^)')
+
+def get_version_key(version):
+    """ Returns a key that sorts versions in the same order as rpmvercmp
+
+    Separators are ignored, numeric segments are newer than alphabetic
+    ones, a '~' is older than anything (even the end of the version) and
+    a '^' is newer than the end of the version but older than anything
+    else.
+    """
+    key = []
+    for segment in _segment_re.findall(version):
+        if segment == '~':
+            key.append((-1,))
+        elif segment == '^':
+            key.append((0.5,))
+        elif segment.isdigit():
+            key.append((2, int(segment)))
+        else:
+            key.append((1, segment))
+    key.append((0,))
+    return tuple(key)
+
+class VersionResolver(object):
+    """ Finds the newest upstream versions matching a release glob """
+
+    def __init__(self, relax=False):
+        self.relax = relax
+        self._matchers = {}
+        self._keys = {}
+
+    def _get_matcher(self, globs):
+        """ Compiles a comma separated list of globs into one regex """
+        matcher = self._matchers.get(globs)
+        if not matcher:
+            regex = '|'.join(['(?:%s)' % fnmatch.translate(g) for g in globs.split(',')])
+            matcher = re.compile(regex).match
+            self._matchers[globs] = matcher
+        return matcher
+
+    def _get_key(self, version):
+        key = self._keys.get(version)
+        if not key:
+            key = get_version_key(version)
+            self._keys[version] = key
+        return key
+
+    def get_newest(self, versions, globs):
+        """ Returns the newest version matching the globs, or None """
+        if not self.relax:
+            matcher = self._get_matcher(globs)
+            versions = [v for v in versions if matcher(v)]
+        if not versions:
+            return None
+        return max(versions, key=self._get_key)
+
+    def get_newest_all(self, candidates):
+        """ Returns the newest versions for a dict of name:(versions, globs) """
+        results = {}
+        for name in candidates:
+            versions, globs = candidates[name]
+            results[name] = self.get_newest(versions, globs)
+        return results